@@ -1,185 +1,250 @@
-import io
+import asyncio
+import hashlib
 import logging
-import os
-import time
 import uuid
-import tempfile
-from typing import List
-
-from fastapi import APIRouter, Depends, File, HTTPException, Response, UploadFile
+from typing import Any
+
+import orjson
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    HTTPException,
+    Request,
+    Response,
+    UploadFile,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
 from app.core.firebase import firebase_user
-from app.schemas.document import (
-    DocumentCreate,
-    ExportFormat,
-    GenerateRequest,
-    SelectQuestionsRequest,
+from app.schemas.document import GenerateRequest
+from app.services.export_service import (
+    build_latex_from_exam,
+    compile_and_cache_pdf,
+    export_key,
+    export_prefix,
+    get_cached_pdf,
+    open_stored_pdf,
 )
-from app.services.export_service import build_latex_from_exam, compile_pdf
 from app.services.firestore_service import (
     create_document,
     get_document,
+    get_document_owner_async,
     list_user_documents,
-    list_generated_exam,
+    list_generated_exam_async,
     list_generated_exams,
     list_original_questions,
+    list_original_questions_by_ids,
     create_generated_exam,
     init_generated_exam_questions,
     delete_document,
     delete_generated_exam,
 )
-from app.services.storage_service import upload_file
+from app.services.storage_service import delete_prefix, upload_fileobj
 from app.workers.queues import enqueue_generate_questions, enqueue_ocr
 
 router = APIRouter(prefix="/documents", tags=["documents"])
 logger = logging.getLogger(__name__)
 
+# Same options ORJSONResponse uses, so tagged and untagged bodies match
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _json_with_etag(request: Request, payload: Any) -> Response:
+    """Serialize payload once, tag it with a content hash and honor If-None-Match"""
+    body = orjson.dumps(payload, default=jsonable_encoder, option=ORJSON_OPTIONS)
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(
+        content=body, media_type="application/json", headers={"ETag": etag}
+    )
+
+
+async def _authorize(doc_id: str, uid: str) -> None:
+    # Owners are cached by the service and evicted when the document is deleted
+    owner = await get_document_owner_async(doc_id)
+    if owner is None:
+        raise HTTPException(404, "Document not found")
+    if owner != uid:
+        raise HTTPException(403, "Forbidden")
+
 
 @router.get("")
-async def list_documents(user=Depends(firebase_user)):
+async def list_documents(request: Request, user=Depends(firebase_user)):
     """List all documents for the authenticated user"""
-    documents = list_user_documents(user["uid"])
-    return {"documents": documents}
+    documents = await run_in_threadpool(list_user_documents, user["uid"])
+    return _json_with_etag(request, {"documents": documents})
 
 
 @router.post("")
 async def upload_document(file: UploadFile = File(...), user=Depends(firebase_user)):
-    content = await file.read()
     doc_id = str(uuid.uuid4())
     storage_path = f"documents/{user['uid']}/{doc_id}/{file.filename}"
-    tmp_path = f"/tmp/{doc_id}_{file.filename}"
-    with open(tmp_path, "wb") as f:
-        f.write(content)
-    upload_file(tmp_path, storage_path, file.content_type or "application/octet-stream")
-    os.remove(tmp_path)
-    create_document(
+    # Stream the spooled upload straight to Storage, without buffering it in memory
+    size = await run_in_threadpool(
+        upload_fileobj,
+        file.file,
+        storage_path,
+        file.content_type or "application/octet-stream",
+    )
+    await run_in_threadpool(
+        create_document,
         doc_id,
         {
             "id": doc_id,
             "filename": file.filename,
             "content_type": file.content_type,
-            "size": len(content),
+            "size": size,
             "storage_path": storage_path,
             "created_by": user["uid"],
             "ocr_status": "pending",
             "extract_status": "pending",
         },
     )
-    job_id = enqueue_ocr(doc_id, storage_path)
+    job_id = await run_in_threadpool(enqueue_ocr, doc_id, storage_path)
     return {"id": doc_id, "job_id": job_id}
 
 
 @router.get("/{doc_id}")
-def get_doc(doc_id: str, user=Depends(firebase_user)):
-    doc = get_document(doc_id)
+async def get_doc(doc_id: str, user=Depends(firebase_user)):
+    doc = await run_in_threadpool(get_document, doc_id)
     if not doc:
         raise HTTPException(404, "Document not found")
     if doc.get("created_by") != user["uid"]:
         raise HTTPException(403, "Forbidden")
-    return doc
+    # Documents carry every OCR page; encode directly, skipping jsonable_encoder
+    return ORJSONResponse(doc)
 
 
 @router.get("/{doc_id}/questions")
-def get_extracted_questions(doc_id: str, user=Depends(firebase_user)):
-    doc = get_document(doc_id)
-    if not doc:
-        raise HTTPException(404, "Document not found")
-    if doc.get("created_by") != user["uid"]:
-        raise HTTPException(403, "Forbidden")
-    return {"questions": list_original_questions(doc_id)}
+async def get_extracted_questions(
+    request: Request, doc_id: str, user=Depends(firebase_user)
+):
+    _, questions = await asyncio.gather(
+        _authorize(doc_id, user["uid"]),
+        run_in_threadpool(list_original_questions, doc_id),
+    )
+    return _json_with_etag(request, {"questions": questions})
 
 
 @router.post("/{doc_id}/generate")
-def start_generation(doc_id: str, body: GenerateRequest, user=Depends(firebase_user)):
-    doc = get_document(doc_id)
-    if not doc:
-        raise HTTPException(404, "Document not found")
-    if doc.get("created_by") != user["uid"]:
-        raise HTTPException(403, "Forbidden")
-    base = list_original_questions(doc_id)
-    id_set = set(body.selected_ids)
-    selected = [q for q in base if q.get("id") in id_set]
+async def start_generation(
+    doc_id: str, body: GenerateRequest, user=Depends(firebase_user)
+):
+    _, selected = await asyncio.gather(
+        _authorize(doc_id, user["uid"]),
+        run_in_threadpool(
+            list_original_questions_by_ids, doc_id, body.selected_ids
+        ),
+    )
     if not selected:
         raise HTTPException(400, "No valid questions selected")
     gen_id = str(uuid.uuid4())
     total = min(len(selected), body.target_count)
-    create_generated_exam(
-        doc_id, gen_id, {"title": f"Generated Exam {gen_id}"}, total=total
+    await run_in_threadpool(
+        create_generated_exam,
+        doc_id,
+        gen_id,
+        {"title": f"Generated Exam {gen_id}"},
+        total=total,
     )
     # Initialize question placeholders with status=pending so UI can display immediately
-    init_generated_exam_questions(doc_id, gen_id, selected[:total])
-    job_ids = enqueue_generate_questions(doc_id, gen_id, selected, body.target_count)
+    await run_in_threadpool(
+        init_generated_exam_questions, doc_id, gen_id, selected[:total]
+    )
+    job_ids = await run_in_threadpool(
+        enqueue_generate_questions, doc_id, gen_id, selected, body.target_count
+    )
     return {"generated_exam_id": gen_id, "job_ids": job_ids, "total": total}
 
 
 @router.get("/{doc_id}/exams/{gen_id}")
-def get_generated_exam(doc_id: str, gen_id: str, user=Depends(firebase_user)):
-    doc = get_document(doc_id)
-    if not doc:
-        raise HTTPException(404, "Document not found")
-    if doc.get("created_by") != user["uid"]:
-        raise HTTPException(403, "Forbidden")
-    return list_generated_exam(doc_id, gen_id)
+async def get_generated_exam(
+    request: Request, doc_id: str, gen_id: str, user=Depends(firebase_user)
+):
+    _, exam = await asyncio.gather(
+        _authorize(doc_id, user["uid"]),
+        list_generated_exam_async(doc_id, gen_id),
+    )
+    return _json_with_etag(request, exam)
 
 
 @router.get("/{doc_id}/exams/{gen_id}/export")
-def export_exam(
-    doc_id: str, gen_id: str, format: str = "latex", user=Depends(firebase_user)
+async def export_exam(
+    request: Request,
+    doc_id: str,
+    gen_id: str,
+    format: str = "latex",
+    user=Depends(firebase_user),
 ):
-    doc = get_document(doc_id)
-    if not doc:
-        raise HTTPException(404, "Document not found")
-    if doc.get("created_by") != user["uid"]:
-        raise HTTPException(403, "Forbidden")
-    exam = list_generated_exam(doc_id, gen_id)
+    _, exam = await asyncio.gather(
+        _authorize(doc_id, user["uid"]),
+        list_generated_exam_async(doc_id, gen_id),
+    )
+    if format not in ("latex", "pdf"):
+        raise HTTPException(400, "Unsupported format")
     tex = build_latex_from_exam(exam)
+    key = export_key(tex)
+    etag = f'"{key}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
     if format == "latex":
-        return Response(content=tex, media_type="application/x-tex")
-    elif format == "pdf":
-        with tempfile.TemporaryDirectory() as tmpdir:
-            tex_path = os.path.join(tmpdir, f"{gen_id}.tex")
-            with open(tex_path, "w", encoding="utf-8") as f:
-                f.write(tex)
-            pdf_path = compile_pdf(tex_path)
-            with open(pdf_path, "rb") as f:
-                data = f.read()
-            headers = {"Content-Disposition": f"attachment; filename={gen_id}.pdf"}
-            return Response(content=data, media_type="application/pdf", headers=headers)
-    else:
-        raise HTTPException(400, "Unsupported format")
+        return Response(
+            content=tex, media_type="application/x-tex", headers={"ETag": etag}
+        )
+    headers = {
+        "Content-Disposition": f"attachment; filename={gen_id}.pdf",
+        "ETag": etag,
+    }
+    data = get_cached_pdf(key)
+    if data is None:
+        stored = await run_in_threadpool(open_stored_pdf, doc_id, gen_id, key)
+        if stored is not None:
+            # Stream the stored artifact in small chunks instead of loading it all
+            chunks, size = stored
+            headers["Content-Length"] = str(size)
+            return StreamingResponse(
+                chunks, media_type="application/pdf", headers=headers
+            )
+        data = await run_in_threadpool(
+            compile_and_cache_pdf, doc_id, gen_id, tex, key
+        )
+    return Response(content=data, media_type="application/pdf", headers=headers)
 
 
 @router.get("/{doc_id}/exams")
-def list_document_exams(doc_id: str, user=Depends(firebase_user)):
+async def list_document_exams(
+    request: Request, doc_id: str, user=Depends(firebase_user)
+):
     """List all generated exams for a document"""
-    doc = get_document(doc_id)
-    if not doc:
-        raise HTTPException(404, "Document not found")
-    if doc.get("created_by") != user["uid"]:
-        raise HTTPException(403, "Forbidden")
-    exams = list_generated_exams(doc_id)
-    return {"exams": exams}
+    _, exams = await asyncio.gather(
+        _authorize(doc_id, user["uid"]),
+        run_in_threadpool(list_generated_exams, doc_id),
+    )
+    return _json_with_etag(request, {"exams": exams})
 
 
 @router.delete("/{doc_id}")
-def delete_doc(doc_id: str, user=Depends(firebase_user)):
+async def delete_doc(doc_id: str, user=Depends(firebase_user)):
     """Delete a document and all its data"""
-    doc = get_document(doc_id)
-    if not doc:
-        raise HTTPException(404, "Document not found")
-    if doc.get("created_by") != user["uid"]:
-        raise HTTPException(403, "Forbidden")
-    delete_document(doc_id)
+    await _authorize(doc_id, user["uid"])
+    await asyncio.gather(
+        run_in_threadpool(delete_document, doc_id),
+        run_in_threadpool(delete_prefix, f"documents/{user['uid']}/{doc_id}/"),
+        run_in_threadpool(delete_prefix, export_prefix(doc_id)),
+    )
     return {"message": "Document deleted successfully"}
 
 
 @router.delete("/{doc_id}/exams/{gen_id}")
-def delete_exam(doc_id: str, gen_id: str, user=Depends(firebase_user)):
+async def delete_exam(doc_id: str, gen_id: str, user=Depends(firebase_user)):
     """Delete a generated exam"""
-    doc = get_document(doc_id)
-    if not doc:
-        raise HTTPException(404, "Document not found")
-    if doc.get("created_by") != user["uid"]:
-        raise HTTPException(403, "Forbidden")
-    delete_generated_exam(doc_id, gen_id)
+    await _authorize(doc_id, user["uid"])
+    await asyncio.gather(
+        run_in_threadpool(delete_generated_exam, doc_id, gen_id),
+        run_in_threadpool(delete_prefix, export_prefix(doc_id, gen_id)),
+    )
     return {"message": "Generated exam deleted successfully"}
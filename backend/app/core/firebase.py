@@ -1,17 +1,40 @@
+import hashlib
 import logging
 import os
-from typing import Optional
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
 from dotenv import load_dotenv
 
 import firebase_admin
+import requests
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from firebase_admin import auth, credentials, firestore, storage
+from firebase_admin import credentials, firestore, firestore_async, storage
+from google.auth import jwt
 
 logger = logging.getLogger(__name__)
 
 _initialized = False
 
+# Public keys used to sign Firebase ID tokens, keyed by kid
+ID_TOKEN_CERTS_URL = (
+    "https://www.googleapis.com/robot/v1/metadata/x509/"
+    "securetoken@system.gserviceaccount.com"
+)
+CERTS_MAX_AGE = 6 * 3600
+
+_certs: Dict[str, str] = {}
+_certs_expire_at = 0.0
+_certs_lock = threading.Lock()
+
+# Recently verified tokens, keyed by a digest of the raw token -> (claims, exp)
+_token_cache: TTLCache = TTLCache(maxsize=50_000, ttl=300)
+
 
 def init_firebase() -> None:
     global _initialized
@@ -34,14 +57,61 @@ def init_firebase() -> None:
     logger.info("Firebase initialized")
 
 
+# Clients are created once per process, after init_firebase() has run
+@lru_cache(maxsize=1)
 def get_firestore() -> firestore.Client:
     return firestore.client()
 
 
+@lru_cache(maxsize=1)
+def get_async_firestore():
+    # Used from the API event loop for reads that do not need a worker thread
+    return firestore_async.client()
+
+
+@lru_cache(maxsize=1)
 def get_bucket():
     return storage.bucket()
 
 
+def _get_certs() -> Dict[str, str]:
+    global _certs, _certs_expire_at
+    with _certs_lock:
+        if _certs and time.time() < _certs_expire_at:
+            return _certs
+        resp = requests.get(ID_TOKEN_CERTS_URL, timeout=10)
+        resp.raise_for_status()
+        # Honor Cache-Control max-age, capped at CERTS_MAX_AGE
+        match = re.search(r"max-age=(\d+)", resp.headers.get("Cache-Control", ""))
+        max_age = min(int(match.group(1)), CERTS_MAX_AGE) if match else CERTS_MAX_AGE
+        _certs = resp.json()
+        _certs_expire_at = time.time() + max_age
+        logger.info("Refreshed Firebase ID token certificates")
+        return _certs
+
+
+def _verify_id_token(token: str) -> Dict[str, Any]:
+    """Verify a Firebase ID token locally against Google's cached public keys"""
+    project_id = firebase_admin.get_app().project_id
+    decoded = jwt.decode(token, certs=_get_certs(), audience=project_id)
+    if decoded.get("iss") != f"https://securetoken.google.com/{project_id}":
+        raise ValueError("Invalid token issuer")
+    if not decoded.get("sub"):
+        raise ValueError("Invalid token subject")
+    decoded["uid"] = decoded["sub"]
+    return decoded
+
+
+async def _cached_verify_id_token(token: str) -> Dict[str, Any]:
+    key = hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+    cached: Optional[Tuple[Dict[str, Any], float]] = _token_cache.get(key)
+    if cached and time.time() < cached[1] - 30:
+        return cached[0]
+    decoded = await run_in_threadpool(_verify_id_token, token)
+    _token_cache[key] = (decoded, float(decoded.get("exp", 0)))
+    return decoded
+
+
 bearer_scheme = HTTPBearer(auto_error=False)
 
 
@@ -52,7 +122,7 @@ async def firebase_user(
         raise HTTPException(status_code=401, detail="Missing or invalid auth token")
     token = credentials.credentials
     try:
-        decoded = auth.verify_id_token(token)
+        decoded = await _cached_verify_id_token(token)
         if "firebase" not in decoded:
             raise HTTPException(status_code=403, detail="Invalid Firebase token")
         provider = decoded.get("firebase", {}).get("sign_in_provider")
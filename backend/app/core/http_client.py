@@ -0,0 +1,30 @@
+import asyncio
+from functools import lru_cache
+
+import httpx
+
+# One pooled HTTP/2 connection set per process for all OpenRouter traffic
+HTTP_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=64, max_connections=128)
+
+
+@lru_cache(maxsize=1)
+def get_http_client() -> httpx.Client:
+    return httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+
+@lru_cache(maxsize=1)
+def get_async_http_client() -> httpx.AsyncClient:
+    # Async connections are bound to the loop that opened them, so the shared
+    # client is only used from get_worker_loop()
+    return httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+
+@lru_cache(maxsize=1)
+def get_worker_loop() -> asyncio.AbstractEventLoop:
+    """Event loop reused by every async job in this process.
+
+    asyncio.run() would start a new loop per job and strand the pooled async
+    client's connections on the previous one.
+    """
+    return asyncio.new_event_loop()
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Any, Optional
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60
+
+# Atomically drop entries older than the window, then either record this
+# request (member "<id>:<tokens>", scored by Redis server time) and return 0,
+# or return the milliseconds until the oldest entry leaves the window
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local window = tonumber(ARGV[1]) * 1000
+local rpm = tonumber(ARGV[2])
+local tpm = tonumber(ARGV[3])
+local tokens = tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local entries = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+local used = 0
+for i = 1, #entries, 2 do
+    used = used + tonumber(string.match(entries[i], ':(%d+)$'))
+end
+if (rpm == 0 or #entries / 2 < rpm) and (tpm == 0 or used + tokens <= tpm) then
+    redis.call('ZADD', KEYS[1], now, ARGV[5] .. ':' .. tokens)
+    redis.call('PEXPIRE', KEYS[1], window)
+    return 0
+end
+return math.max(1, tonumber(entries[2]) + window - now)
+"""
+
+
+class RateLimiter:
+    """Sliding one-minute window over requests and tokens sent to a provider.
+
+    The window lives in Redis, so every API and RQ worker process calling the
+    provider counts against the same account-wide budget. A limit of 0
+    disables that dimension. If Redis is unreachable, requests are let through
+    rather than failing the job.
+    """
+
+    def __init__(self, name: str, requests_per_min: int, tokens_per_min: int) -> None:
+        self.key = f"rate_limit:{name}"
+        self.requests_per_min = requests_per_min
+        self.tokens_per_min = tokens_per_min
+        self._script: Optional[Any] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.requests_per_min or self.tokens_per_min)
+
+    def _try_acquire(self, expected_tokens: int) -> float:
+        """Record the request if it fits; otherwise return seconds to wait"""
+        if self._script is None:
+            from app.workers.queues import get_redis
+
+            self._script = get_redis().register_script(_ACQUIRE_SCRIPT)
+        if self.tokens_per_min:
+            expected_tokens = min(expected_tokens, self.tokens_per_min)
+        try:
+            wait_ms = self._script(
+                keys=[self.key],
+                args=[
+                    WINDOW_SECONDS,
+                    self.requests_per_min,
+                    self.tokens_per_min,
+                    max(0, int(expected_tokens)),
+                    uuid.uuid4().hex,
+                ],
+            )
+        except RedisError as e:
+            logger.warning("Rate limiter unavailable, not throttling: %s", e)
+            return 0.0
+        return int(wait_ms) / 1000
+
+    def acquire(self, expected_tokens: int = 0) -> None:
+        if not self.enabled:
+            return
+        while True:
+            wait = self._try_acquire(expected_tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, expected_tokens: int = 0) -> None:
+        if not self.enabled:
+            return
+        while True:
+            # The Redis round trip is blocking, keep it off the event loop
+            wait = await asyncio.to_thread(self._try_acquire, expected_tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+# Shared by every OCR and generation request to OpenRouter, across processes
+openrouter_limiter = RateLimiter(
+    "openrouter",
+    requests_per_min=int(os.getenv("OPENROUTER_RPM", "0")),
+    tokens_per_min=int(os.getenv("OPENROUTER_TPM", "0")),
+)
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English/LaTeX-heavy prompts
+    return len(text) // 4
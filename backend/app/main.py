@@ -1,11 +1,35 @@
 import logging
+import os
+from contextlib import asynccontextmanager
+
+from anyio import to_thread
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 
 from app.core.firebase import init_firebase
 from app.core.logging_config import configure_logging
 from app.api.routes import router as api_router
+from app.services.export_service import shutdown_render_pool, start_render_pool
+from app.services.firestore_service import (
+    start_cache_invalidation,
+    stop_cache_invalidation,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Route handlers offload blocking Firestore/Storage calls through
+    # run_in_threadpool, so raise anyio's default limit of 40 threads
+    limiter = to_thread.current_default_thread_limiter()
+    limiter.total_tokens = int(os.getenv("API_THREAD_LIMIT", "128"))
+    start_render_pool()
+    start_cache_invalidation()
+    yield
+    stop_cache_invalidation()
+    shutdown_render_pool()
 
 
 def create_app() -> FastAPI:
@@ -14,17 +38,29 @@ def create_app() -> FastAPI:
     configure_logging()
     init_firebase()
 
-    app = FastAPI(title="DethiAI Backend", version="0.1.0")
+    app = FastAPI(
+        title="DethiAI Backend",
+        version="0.1.0",
+        lifespan=lifespan,
+        default_response_class=ORJSONResponse,
+    )
 
-    # Adjust CORS as needed for your frontend domains
+    # Pin CORS to the frontend origins (comma separated) and let browsers
+    # cache preflight responses for a day
+    origins = os.getenv("FRONTEND_ORIGIN", "http://localhost:3000").split(",")
     app.add_middleware(
         CORSMiddleware,
-        allow_origins=["*"],
+        allow_origins=[o.strip() for o in origins if o.strip()],
         allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
+        allow_methods=["GET", "POST", "DELETE"],
+        allow_headers=["Authorization", "Content-Type", "If-None-Match"],
+        expose_headers=["ETag"],
+        max_age=86400,
     )
 
+    # Exam payloads are markdown/LaTeX-heavy JSON and compress well
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
+
     @app.get("/healthz")
     def healthz():
         return {"status": "ok"}
@@ -39,4 +75,13 @@ app = create_app()
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8080,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", str(max(2, os.cpu_count() or 1)))),
+        backlog=2048,
+        timeout_keep_alive=30,
+    )
@@ -1,4 +1,4 @@
-from typing import List, Literal, Optional, Union
+from typing import Annotated, List, Literal, Optional, Union
 from pydantic import BaseModel, Field
 
 # ==============================================================================
@@ -71,8 +71,9 @@ class ShortAnswerQuestion(BaseQuestionElement):
 
 # This Union allows Pydantic to automatically determine the correct model
 # for an element based on the value of its 'type' field.
-AnyElement = Union[
-    TextElement, MultipleChoiceQuestion, TrueFalseQuestion, ShortAnswerQuestion
+AnyElement = Annotated[
+    Union[TextElement, MultipleChoiceQuestion, TrueFalseQuestion, ShortAnswerQuestion],
+    Field(discriminator="type"),
 ]
 
 
@@ -163,11 +164,14 @@ class ShortAnswerQuestionWithAnswer(ShortAnswerQuestion):
     answer: ShortAnswerAnswer
 
 
-AnyElementWithAnswer = Union[
-    TextElement,
-    MultipleChoiceQuestionWithAnswer,
-    TrueFalseQuestionWithAnswer,
-    ShortAnswerQuestionWithAnswer,
+AnyElementWithAnswer = Annotated[
+    Union[
+        TextElement,
+        MultipleChoiceQuestionWithAnswer,
+        TrueFalseQuestionWithAnswer,
+        ShortAnswerQuestionWithAnswer,
+    ],
+    Field(discriminator="type"),
 ]
 
 
@@ -1,100 +1,221 @@
+import glob
+import hashlib
+import io
 import logging
+import multiprocessing
 import os
 import subprocess
 import tempfile
-from typing import Dict, List, Tuple
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import orjson
+from cachetools import LRUCache
+
+from app.services.storage_service import open_stream, upload_bytes
 
 logger = logging.getLogger(__name__)
 
+EXPORTS_PREFIX = "exports"
+
+BLOCK_SEP = "\n\n"
+OPTION_LETTERS = tuple(chr(65 + i) for i in range(26))
+TF_LABELS = {True: "Đúng", False: "Sai"}
+
+# Shared preamble, also dumped into a precompiled pdflatex format at build time
+PREAMBLE_PATH = "./app/latex/exam_preamble.tex"
+LATEX_FORMAT_PATH = os.getenv("LATEX_FORMAT_PATH", "./app/latex/exam.fmt")
+
+# Long-lived pdflatex workers, each compiling in its own reusable scratch dir
+_render_pool: Optional[ProcessPoolExecutor] = None
+_scratch_dir: Optional[str] = None
+
+# Hot compiled PDFs, keyed by the hash of their LaTeX source
+_pdf_cache: LRUCache = LRUCache(maxsize=64)
+_pdf_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _load_preamble() -> str:
+    with open(PREAMBLE_PATH, "r", encoding="utf-8") as f:
+        return f.read()
+
 
 def build_latex_from_exam(exam: Dict) -> str:
-    preamble = r"""\documentclass{article}
-\usepackage[utf8]{inputenc}
-\usepackage[margin=2cm]{geometry}
-\usepackage{amsmath}
-\usepackage{amssymb}
-\usepackage{graphicx}
-\usepackage{enumitem}
-\usepackage[utf8]{vietnam}
-\setlist[itemize]{leftmargin=*, itemindent=0pt, labelsep=0.5em}
-\setlist[enumerate]{leftmargin=*, itemindent=0pt, labelsep=0.5em}
-\begin{document}
-"""
+    # Memoize on the canonical JSON so unchanged exams skip rendering
+    return _build_latex_cached(orjson.dumps(exam, option=orjson.OPT_SORT_KEYS))
+
+
+def export_key(content: str) -> str:
+    """Content hash used as the export ETag and storage cache key."""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=128)
+def _build_latex_cached(exam_json: bytes) -> str:
+    exam = orjson.loads(exam_json)
+    preamble = _load_preamble()
     postamble = "\n\\end{document}\n"
 
-    body: List[str] = []
-    body.append(f"\\section*{{{exam['metadata'].get('title', 'Exam')}}}")
+    # Blocks are separated by a blank line; write straight into one buffer.
+    # StringIO only takes str, and LLM-produced values may be numbers
+    buf = io.StringIO()
+    write = buf.write
+    write(preamble)
+    write("\\section*{")
+    write(str(exam["metadata"].get("title", "Exam")))
+    write("}")
 
-    question_number = 1
+    state = SimpleNamespace(write=write, question_number=1)
     for el in exam["elements"]:
-        if el.get("type") == "text":
-            body.append(el.get("content", ""))
-        elif el.get("type") == "multiple_choice":
-            body.append(f"\\paragraph{{Câu {question_number}:}} {el['content']}")
-            opts = el.get("data", {}).get("options", [])
-            body.append("\\begin{enumerate}[label=\\Alph*.]")
-            for o in opts:
-                body.append(f"  \\item {o}")
-            body.append("\\end{enumerate}")
-            if "answer" in el and el["answer"]:
-                ans = el["answer"]
-                body.append(
-                    f"\\paragraph{{Đáp án:}} {chr(65 + ans.get('correct_option', 0))}"
-                )
-                if ans.get("explanation"):
-                    body.append("\\paragraph{Lời giải:} " + ans["explanation"])
-
-                if ans.get("error_analysis"):
-                    body.append("\\paragraph{Tại sao các đáp án khác sai:}")
-                    body.append("\\begin{itemize}")
-                    correct_option = ans.get("correct_option", 0)
-                    for i, err in enumerate(ans["error_analysis"]):
-                        # Skip the correct option
-                        if i != correct_option:
-                            option_letter = chr(65 + i)  # A, B, C, D
-                            body.append(f"\\item \\textbf{{{option_letter}.}} {err}")
-                    body.append("\\end{itemize}")
-            question_number += 1
-        elif el.get("type") == "true_false":
-            body.append(f"\\paragraph{{Câu {question_number}:}} {el['content']}")
-            clauses = el.get("data", {}).get("clauses", [])
-            body.append("\\begin{enumerate}")
-            for c in clauses:
-                body.append(f"  \\item {c}")
-            body.append("\\end{enumerate}")
-            if "answer" in el and el["answer"]:
-                ans = el["answer"]
-                tf = ["Đúng" if b else "Sai" for b in ans.get("clause_correctness", [])]
-                body.append("\\textbf{Đáp án:} " + ", ".join(tf))
-                if ans.get("general_explanation"):
-                    body.append("\\textbf{Lời giải:} " + ans["general_explanation"])
-                # Detailed explanations per clause
-                if ans.get("explanations"):
-                    body.append("\\textbf{Giải thích chi tiết:}")
-                    body.append("\\begin{itemize}")
-                    for i, exp in enumerate(ans["explanations"]):
-                        body.append(f"\\item {clauses[i]}: {exp}")
-                    body.append("\\end{itemize}")
-            question_number += 1
-        elif el.get("type") == "short_answer":
-            body.append(f"\\paragraph{{Câu {question_number}:}} {el['content']}")
-            if "answer" in el and el["answer"]:
-                ans = el["answer"]
-                body.append("\\textbf{Answer:} " + ans.get("answer_text", ""))
-                if ans.get("explanation"):
-                    body.append("\\textbf{Lời giải:} " + ans["explanation"])
-            question_number += 1
-
-    return preamble + "\n\n".join(body) + postamble
+        handler = _HANDLERS.get(el.get("type"))
+        if handler is not None:
+            handler(el, state)
+
+    write(postamble)
+    return buf.getvalue()
+
+
+def _render_text(el: Dict, state: SimpleNamespace) -> None:
+    state.write(BLOCK_SEP)
+    state.write(el.get("content", ""))
+
+
+def _render_multiple_choice(el: Dict, state: SimpleNamespace) -> None:
+    write = state.write
+    _write_question_header(write, state.question_number, el["content"])
+    opts = el.get("data", {}).get("options", [])
+    write(BLOCK_SEP)
+    write("\\begin{enumerate}[label=\\Alph*.]")
+    for o in opts:
+        write(BLOCK_SEP)
+        write("  \\item ")
+        write(str(o))
+    write(BLOCK_SEP)
+    write("\\end{enumerate}")
+    if "answer" in el and el["answer"]:
+        ans = el["answer"]
+        write(BLOCK_SEP)
+        write("\\paragraph{Đáp án:} ")
+        write(OPTION_LETTERS[ans.get("correct_option", 0)])
+        if ans.get("explanation"):
+            write(BLOCK_SEP)
+            write("\\paragraph{Lời giải:} ")
+            write(ans["explanation"])
+
+        if ans.get("error_analysis"):
+            write(BLOCK_SEP)
+            write("\\paragraph{Tại sao các đáp án khác sai:}")
+            write(BLOCK_SEP)
+            write("\\begin{itemize}")
+            correct_option = ans.get("correct_option", 0)
+            for i, err in enumerate(ans["error_analysis"]):
+                # Skip the correct option
+                if i != correct_option:
+                    write(BLOCK_SEP)
+                    write("\\item \\textbf{")
+                    write(OPTION_LETTERS[i])
+                    write(".} ")
+                    write(str(err))
+            write(BLOCK_SEP)
+            write("\\end{itemize}")
+    state.question_number += 1
+
+
+def _render_true_false(el: Dict, state: SimpleNamespace) -> None:
+    write = state.write
+    _write_question_header(write, state.question_number, el["content"])
+    clauses = el.get("data", {}).get("clauses", [])
+    write(BLOCK_SEP)
+    write("\\begin{enumerate}")
+    for c in clauses:
+        write(BLOCK_SEP)
+        write("  \\item ")
+        write(str(c))
+    write(BLOCK_SEP)
+    write("\\end{enumerate}")
+    if "answer" in el and el["answer"]:
+        ans = el["answer"]
+        write(BLOCK_SEP)
+        write("\\textbf{Đáp án:} ")
+        write(
+            ", ".join(
+                map(TF_LABELS.__getitem__, map(bool, ans.get("clause_correctness", [])))
+            )
+        )
+        if ans.get("general_explanation"):
+            write(BLOCK_SEP)
+            write("\\textbf{Lời giải:} ")
+            write(ans["general_explanation"])
+        # Detailed explanations per clause
+        if ans.get("explanations"):
+            write(BLOCK_SEP)
+            write("\\textbf{Giải thích chi tiết:}")
+            write(BLOCK_SEP)
+            write("\\begin{itemize}")
+            for i, exp in enumerate(ans["explanations"]):
+                write(BLOCK_SEP)
+                write("\\item ")
+                write(str(clauses[i]))
+                write(": ")
+                write(str(exp))
+            write(BLOCK_SEP)
+            write("\\end{itemize}")
+    state.question_number += 1
+
+
+def _render_short_answer(el: Dict, state: SimpleNamespace) -> None:
+    write = state.write
+    _write_question_header(write, state.question_number, el["content"])
+    if "answer" in el and el["answer"]:
+        ans = el["answer"]
+        write(BLOCK_SEP)
+        write("\\textbf{Answer:} ")
+        write(str(ans.get("answer_text", "")))
+        if ans.get("explanation"):
+            write(BLOCK_SEP)
+            write("\\textbf{Lời giải:} ")
+            write(ans["explanation"])
+    state.question_number += 1
+
+
+def _write_question_header(write, question_number: int, content: str) -> None:
+    write(BLOCK_SEP)
+    write("\\paragraph{Câu ")
+    write(str(question_number))
+    write(":} ")
+    write(str(content))
+
+
+# Element type -> renderer; unknown types are skipped
+_HANDLERS: Dict[str, Callable[[Dict, SimpleNamespace], None]] = {
+    "text": _render_text,
+    "multiple_choice": _render_multiple_choice,
+    "true_false": _render_true_false,
+    "short_answer": _render_short_answer,
+}
 
 
 def compile_pdf(tex_path: str) -> str:
     workdir = os.path.dirname(tex_path)
     name = os.path.splitext(os.path.basename(tex_path))[0]
+    cmd = ["pdflatex", "-interaction=nonstopmode"]
+    env = None
+    fmt_path = os.path.abspath(LATEX_FORMAT_PATH)
+    if os.path.exists(fmt_path):
+        # The precompiled format already holds the preamble, so pdflatex
+        # skips re-reading the document class and packages on every export
+        fmt_dir, fmt_file = os.path.split(fmt_path)
+        cmd.append("-fmt=" + os.path.splitext(fmt_file)[0])
+        env = {**os.environ, "TEXFORMATS": fmt_dir + os.pathsep}
     try:
         subprocess.run(
-            ["pdflatex", "-interaction=nonstopmode", name + ".tex"],
+            cmd + [name + ".tex"],
             cwd=workdir,
+            env=env,
             check=True,
             capture_output=True,
             text=True,
@@ -106,3 +227,88 @@ def compile_pdf(tex_path: str) -> str:
     except subprocess.CalledProcessError as e:
         logger.error("pdflatex failed: %s", e.stderr)
         raise
+
+
+def start_render_pool() -> None:
+    global _render_pool
+    if _render_pool is not None:
+        return
+    workers = int(os.getenv("EXPORT_WORKERS", str(os.cpu_count() or 1)))
+    # Spawn rather than fork: by now the API process runs gRPC and Firestore
+    # listener threads, and forking a multithreaded gRPC process can deadlock
+    _render_pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_render_worker,
+    )
+    logger.info("Started PDF render pool with %d workers", workers)
+
+
+def shutdown_render_pool() -> None:
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+
+def _init_render_worker() -> None:
+    global _scratch_dir
+    # Prefer tmpfs so intermediate LaTeX files never touch the disk
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    _scratch_dir = os.path.join(base, f"latex-{os.getpid()}")
+    os.makedirs(_scratch_dir, exist_ok=True)
+
+
+def _render_in_worker(tex: str, name: str) -> bytes:
+    tex_path = os.path.join(_scratch_dir, f"{name}.tex")
+    try:
+        with open(tex_path, "w", encoding="utf-8") as f:
+            f.write(tex)
+        pdf_path = compile_pdf(tex_path)
+        with open(pdf_path, "rb") as f:
+            return f.read()
+    finally:
+        for path in glob.glob(os.path.join(_scratch_dir, f"{name}.*")):
+            os.remove(path)
+
+
+def render_pdf(tex: str, name: str) -> bytes:
+    """Compile LaTeX source and return the PDF bytes."""
+    if _render_pool is not None:
+        return _render_pool.submit(_render_in_worker, tex, name).result()
+    # No pool in this process (e.g. RQ workers), compile in a throwaway dir
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tex_path = os.path.join(tmpdir, f"{name}.tex")
+        with open(tex_path, "w", encoding="utf-8") as f:
+            f.write(tex)
+        pdf_path = compile_pdf(tex_path)
+        with open(pdf_path, "rb") as f:
+            return f.read()
+
+
+def export_prefix(doc_id: str, gen_id: Optional[str] = None) -> str:
+    """Storage prefix holding cached exports of a document, or of one exam."""
+    if gen_id is None:
+        return f"{EXPORTS_PREFIX}/{doc_id}/"
+    return f"{EXPORTS_PREFIX}/{doc_id}/{gen_id}/"
+
+
+def get_cached_pdf(key: str) -> Optional[bytes]:
+    with _pdf_cache_lock:
+        return _pdf_cache.get(key)
+
+
+def open_stored_pdf(
+    doc_id: str, gen_id: str, key: str
+) -> Optional[Tuple[Iterator[bytes], int]]:
+    """Stream a previously compiled PDF from Storage, if one exists for key."""
+    return open_stream(f"{export_prefix(doc_id, gen_id)}{key}.pdf")
+
+
+def compile_and_cache_pdf(doc_id: str, gen_id: str, tex: str, key: str) -> bytes:
+    logger.info("Export cache miss for %s, compiling PDF", gen_id)
+    data = render_pdf(tex, gen_id)
+    upload_bytes(data, f"{export_prefix(doc_id, gen_id)}{key}.pdf", "application/pdf")
+    with _pdf_cache_lock:
+        _pdf_cache[key] = data
+    return data
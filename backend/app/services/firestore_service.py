@@ -1,11 +1,28 @@
+import asyncio
 import logging
+import os
+import threading
 import time
-from typing import Any, Dict, List, Optional
-
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+from cachetools import TTLCache
+from google.api_core import retry
+from google.api_core.exceptions import (
+    Aborted,
+    DeadlineExceeded,
+    NotFound,
+    ResourceExhausted,
+)
 from google.cloud.firestore_v1.base_query import FieldFilter
+from redis import Redis
+from redis.exceptions import RedisError
 
-from app.core.firebase import get_firestore
-from google.cloud.firestore_v1 import Increment
+from app.core.firebase import get_async_firestore, get_firestore
+from google.cloud.firestore_v1 import Increment, transactional
+from google.cloud.firestore_v1.field_path import FieldPath
 
 logger = logging.getLogger(__name__)
 
@@ -13,24 +30,97 @@ DOCS = "documents"
 SUB_GENERATED = "generated_exams"
 SUB_QUESTIONS = "questions"
 
+# Writes per batch commit, kept under Firestore's cap of 500 per batch
+BATCH_CHUNK_SIZE = 400
+BATCH_COMMIT_WORKERS = 20
+# Budget for batched writes in this process; Firestore recommends staying
+# under 10k writes/sec per database, so lower it when running many workers
+MAX_WRITES_PER_SEC = int(os.getenv("FIRESTORE_MAX_WRITES_PER_SEC", "10000"))
+
+# Batches only contain sets, so replaying a commit is safe
+COMMIT_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(Aborted, ResourceExhausted, DeadlineExceeded),
+    initial=0.1,
+    maximum=10.0,
+    multiplier=2.0,
+)
+
+# Read caches for get_document / list_generated_exam_async. They are only used once
+# start_cache_invalidation() has subscribed to changes published by any process
+_doc_cache: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+_exam_cache: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+# Ownership never changes after upload, so an entry only goes with its document
+_owner_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_cache_lock = threading.Lock()
+# Writers publish the ids they changed here; subscribed processes evict them
+INVALIDATION_CHANNEL = "firestore:invalidate"
+_cache_subscriber: Optional[Any] = None
+# Bumped on every eviction so a fetch racing with a change is not cached
+_cache_epoch = 0
+
+
+# References are built from a single path string rather than a chain of
+# collection()/document() calls that creates an object per segment
+def _doc_ref(doc_id: str):
+    return get_firestore().document(f"{DOCS}/{doc_id}")
+
+
+def _exam_ref(doc_id: str, gen_id: str):
+    return get_firestore().document(f"{DOCS}/{doc_id}/{SUB_GENERATED}/{gen_id}")
+
+
+def _generated_question_ref(doc_id: str, gen_id: str, question_id: str):
+    return get_firestore().document(
+        f"{DOCS}/{doc_id}/{SUB_GENERATED}/{gen_id}/{SUB_QUESTIONS}/{question_id}"
+    )
+
 
 def create_document(doc_id: str, payload: Dict[str, Any]) -> None:
-    db = get_firestore()
     data = {**payload, "created_at": time.time()}
-    db.collection(DOCS).document(doc_id).set(data)
+    _doc_ref(doc_id).set(data)
+    _changed(doc_id)
 
 
 def update_document(doc_id: str, patch: Dict[str, Any]) -> None:
-    db = get_firestore()
-    db.collection(DOCS).document(doc_id).set(patch, merge=True)
+    _doc_ref(doc_id).set(patch, merge=True)
+    _changed(doc_id)
 
 
 def get_document(doc_id: str) -> Optional[Dict[str, Any]]:
-    db = get_firestore()
-    snap = db.collection(DOCS).document(doc_id).get()
+    if _cache_subscriber is None:
+        return _fetch_document(doc_id)
+    with _cache_lock:
+        if doc_id in _doc_cache:
+            return _doc_cache[doc_id]
+        epoch = _cache_epoch
+    doc = _fetch_document(doc_id)
+    with _cache_lock:
+        if epoch == _cache_epoch:
+            _doc_cache[doc_id] = doc
+    return doc
+
+
+def _fetch_document(doc_id: str) -> Optional[Dict[str, Any]]:
+    snap = _doc_ref(doc_id).get()
     return snap.to_dict() if snap.exists else None
 
 
+async def get_document_owner_async(doc_id: str) -> Optional[str]:
+    """Fetch only the created_by field, or None if the document does not exist"""
+    with _cache_lock:
+        owner = _owner_cache.get(doc_id)
+        epoch = _cache_epoch
+    if owner is not None:
+        return owner
+    db = get_async_firestore()
+    snap = await db.collection(DOCS).document(doc_id).get(field_paths=["created_by"])
+    owner = snap.get("created_by") if snap.exists else None
+    with _cache_lock:
+        if owner is not None and epoch == _cache_epoch:
+            _owner_cache[doc_id] = owner
+    return owner
+
+
 def list_user_documents(user_id: str) -> List[Dict[str, Any]]:
     db = get_firestore()
     query = db.collection(DOCS).where(filter=FieldFilter("created_by", "==", user_id))
@@ -43,33 +133,132 @@ def list_user_documents(user_id: str) -> List[Dict[str, Any]]:
 
 
 def save_original_exam(doc_id: str, exam: Dict[str, Any]) -> None:
-    db = get_firestore()
-    doc_ref = db.collection(DOCS).document(doc_id)
-    doc_ref.collection(SUB_QUESTIONS).document("_meta").set({"type": "original"})
+    doc_ref = _doc_ref(doc_id)
+    questions = doc_ref.collection(SUB_QUESTIONS)
+    writes: List[Tuple[Any, Dict[str, Any], bool]] = []
 
-    # Extract only questions (not text elements) and use 0-based document IDs
+    # Extract only questions (not text elements) and use 0-based document IDs,
+    # zero-padded so Firestore's document-name order is the numeric order
     question_index = 0
     for el in exam.get("elements", []):
         if el.get("type") == "text":
             continue
         # Create question with 0-based document ID, no index field needed
         el_copy = {k: v for k, v in el.items()}
-        doc_ref.collection(SUB_QUESTIONS).document(str(question_index)).set(el_copy)
+        qref = questions.document(_question_id(question_index))
+        writes.append((qref, el_copy, False))
         question_index += 1
 
-    doc_ref.set({"original_exam": {"metadata": exam.get("metadata", {})}}, merge=True)
+    # The "original" marker lives on the parent doc rather than in a _meta
+    # question document that every listing had to skip
+    writes.append(
+        (
+            doc_ref,
+            {
+                "original_exam": {
+                    "type": "original",
+                    "metadata": exam.get("metadata", {}),
+                }
+            },
+            True,
+        )
+    )
+    _commit_batched(writes)
+    _changed(doc_id)
+
+
+def _commit_batched(writes: List[Tuple[Any, Dict[str, Any], bool]]) -> None:
+    """Apply (ref, data, merge) sets as batch commits, running chunks concurrently"""
+    chunks = [
+        writes[start : start + BATCH_CHUNK_SIZE]
+        for start in range(0, len(writes), BATCH_CHUNK_SIZE)
+    ]
+    if len(chunks) <= 1:
+        for chunk in chunks:
+            _commit_chunk(chunk)
+        return
+    workers = min(BATCH_COMMIT_WORKERS, len(chunks))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first failed commit after all chunks have run
+        list(executor.map(_commit_chunk, chunks))
+
+
+def _commit_chunk(chunk: List[Tuple[Any, Dict[str, Any], bool]]) -> None:
+    batch = get_firestore().batch()
+    for ref, data, merge in chunk:
+        batch.set(ref, data, merge=merge)
+    _write_limiter.acquire(len(chunk))
+    batch.commit(retry=COMMIT_RETRY)
+
+
+class _WriteLimiter:
+    """Token bucket refilled continuously at `rate` writes per second"""
+
+    def __init__(self, rate: int) -> None:
+        self.rate = max(1, rate)
+        self.tokens = float(self.rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n: int) -> None:
+        n = min(n, self.rate)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.rate, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_write_limiter = _WriteLimiter(MAX_WRITES_PER_SEC)
+
+
+def _question_id(index: int) -> str:
+    return f"{index:06d}"
 
 
 def list_original_questions(doc_id: str) -> List[Dict[str, Any]]:
-    db = get_firestore()
-    col = db.collection(DOCS).document(doc_id).collection(SUB_QUESTIONS)
+    col = _doc_ref(doc_id).collection(SUB_QUESTIONS)
     docs = []
-    for d in col.stream():
+    for d in col.order_by(FieldPath.document_id()).stream():
+        # Documents saved before ids were padded still carry a _meta marker
         if d.id != "_meta":
             data = d.to_dict()
-            data["id"] = d.id  # Document ID is now the 0-based index
+            data["id"] = d.id  # Document ID is the 0-based index
             docs.append(data)
-    # Sort by document ID (which is the 0-based index as string)
+    # Results are already ordered for padded ids, which this stable sort keeps
+    # in a single pass; it only reorders documents saved with unpadded ids
+    return sorted(
+        docs, key=lambda x: int(x["id"]) if x["id"].isdigit() else float("inf")
+    )
+
+
+def list_original_questions_by_ids(
+    doc_id: str, question_ids: List[str]
+) -> List[Dict[str, Any]]:
+    """Fetch only the given original questions in one batched read"""
+    db = get_firestore()
+    col = _doc_ref(doc_id).collection(SUB_QUESTIONS)
+    refs = [
+        col.document(qid)
+        for qid in dict.fromkeys(question_ids)
+        if qid and "/" not in qid and qid != "_meta"
+    ]
+    if not refs:
+        return []
+    docs = []
+    for d in db.get_all(refs):
+        if d.exists:
+            data = d.to_dict()
+            data["id"] = d.id
+            docs.append(data)
+    # get_all does not preserve order, sort like list_original_questions
     return sorted(
         docs, key=lambda x: int(x["id"]) if x["id"].isdigit() else float("inf")
     )
@@ -78,8 +267,7 @@ def list_original_questions(doc_id: str) -> List[Dict[str, Any]]:
 def create_generated_exam(
     doc_id: str, gen_id: str, exam_meta: Dict[str, Any], total: int = 0
 ) -> None:
-    db = get_firestore()
-    db.collection(DOCS).document(doc_id).collection(SUB_GENERATED).document(gen_id).set(
+    _exam_ref(doc_id, gen_id).set(
         {
             "metadata": exam_meta,
             "status": "processing" if total > 0 else "pending",
@@ -88,29 +276,45 @@ def create_generated_exam(
             "completed": 0,
         }
     )
-
-
-def append_generated_question(
-    doc_id: str, gen_id: str, question_index: int, el: Dict[str, Any]
-) -> None:
-    db = get_firestore()
-    doc_ref = (
+    _changed(doc_id, gen_id)
+
+
+async def list_generated_exam_async(doc_id: str, gen_id: str) -> Dict[str, Any]:
+    """Fetch a generated exam with its questions, cached like get_document"""
+    if _cache_subscriber is None:
+        return await _fetch_generated_exam_async(doc_id, gen_id)
+    key = (doc_id, gen_id)
+    with _cache_lock:
+        if key in _exam_cache:
+            return _exam_cache[key]
+        epoch = _cache_epoch
+    exam = await _fetch_generated_exam_async(doc_id, gen_id)
+    with _cache_lock:
+        if epoch == _cache_epoch:
+            _exam_cache[key] = exam
+    return exam
+
+
+async def _fetch_generated_exam_async(doc_id: str, gen_id: str) -> Dict[str, Any]:
+    db = get_async_firestore()
+    base_ref = (
         db.collection(DOCS).document(doc_id).collection(SUB_GENERATED).document(gen_id)
     )
-    # Update the pre-created question document using index as ID, no index field needed
-    qref = doc_ref.collection(SUB_QUESTIONS).document(str(question_index))
-    data = {**el, "status": "done", "updated_at": time.time()}
-    qref.set(data, merge=True)
 
+    async def collect_questions() -> List[Any]:
+        return [d async for d in base_ref.collection(SUB_QUESTIONS).stream()]
 
-def list_generated_exam(doc_id: str, gen_id: str) -> Dict[str, Any]:
-    db = get_firestore()
-    base_ref = (
-        db.collection(DOCS).document(doc_id).collection(SUB_GENERATED).document(gen_id)
+    meta_snap, question_snaps = await asyncio.gather(
+        base_ref.get(), collect_questions()
     )
-    meta = base_ref.get().to_dict() or {}
+    return _shape_generated_exam(meta_snap.to_dict() or {}, question_snaps)
+
+
+def _shape_generated_exam(
+    meta: Dict[str, Any], question_snaps: List[Any]
+) -> Dict[str, Any]:
     questions = []
-    for d in base_ref.collection(SUB_QUESTIONS).stream():
+    for d in question_snaps:
         data = d.to_dict()
         data["id"] = d.id  # Add document ID
         questions.append(data)
@@ -135,51 +339,162 @@ def list_generated_exam(doc_id: str, gen_id: str) -> Dict[str, Any]:
     }
 
 
+def start_cache_invalidation() -> None:
+    """Enable the read caches, evicting entries as writers publish changes.
+
+    Every write helper in this module publishes the ids it changed, deletes
+    included, so no process has to watch Firestore itself. If Redis is
+    unreachable, or the subscription later fails, the caches stay off rather
+    than serve entries nobody will invalidate.
+    """
+    global _cache_subscriber
+    if _cache_subscriber is not None:
+        return
+    try:
+        pubsub = _redis().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: _on_change})
+    except RedisError as e:
+        logger.error("Cache invalidation unavailable, read caches disabled: %s", e)
+        return
+    _cache_subscriber = pubsub.run_in_thread(
+        sleep_time=1.0, daemon=True, exception_handler=_on_subscriber_error
+    )
+    logger.info("Document cache invalidation subscriber started")
+
+
+def stop_cache_invalidation() -> None:
+    global _cache_subscriber
+    subscriber, _cache_subscriber = _cache_subscriber, None
+    if subscriber is not None:
+        subscriber.stop()
+    with _cache_lock:
+        _doc_cache.clear()
+        _exam_cache.clear()
+        _owner_cache.clear()
+
+
+def _on_subscriber_error(exc: BaseException, pubsub, thread) -> None:
+    # Changes published while disconnected are lost, so nothing cached can be
+    # trusted any more
+    logger.error("Cache invalidation subscriber failed, disabling caches: %s", exc)
+    stop_cache_invalidation()
+
+
+def _on_change(message: Dict[str, Any]) -> None:
+    change = orjson.loads(message["data"])
+    _invalidate(change["doc"], change.get("gen"), change.get("removed", False))
+
+
+@lru_cache(maxsize=1)
+def _redis() -> Redis:
+    from app.workers.queues import get_redis
+
+    return get_redis()
+
+
+def _changed(
+    doc_id: str, gen_id: Optional[str] = None, removed: bool = False
+) -> None:
+    """Evict a written document or exam here and in every subscribed process"""
+    _invalidate(doc_id, gen_id, removed)
+    _publish_change({"doc": doc_id, "gen": gen_id, "removed": removed})
+
+
+def _publish_change(change: Dict[str, Any]) -> None:
+    try:
+        _redis().publish(INVALIDATION_CHANNEL, orjson.dumps(change))
+    except RedisError as e:
+        # Other processes fall back on the cache TTL
+        logger.warning("Failed to publish cache invalidation %s: %s", change, e)
+
+
+def _invalidate(
+    doc_id: Optional[str], gen_id: Optional[str] = None, removed: bool = False
+) -> None:
+    global _cache_epoch
+    if doc_id is None:
+        return
+    with _cache_lock:
+        _cache_epoch += 1
+        if gen_id is not None:
+            _exam_cache.pop((doc_id, gen_id), None)
+            return
+        _doc_cache.pop(doc_id, None)
+        if removed:
+            # A deleted document takes its owner and generated exams with it
+            _owner_cache.pop(doc_id, None)
+            for key in [key for key in _exam_cache if key[0] == doc_id]:
+                _exam_cache.pop(key, None)
+
+
 def set_generated_exam_status(doc_id: str, gen_id: str, status: str) -> None:
-    db = get_firestore()
-    db.collection(DOCS).document(doc_id).collection(SUB_GENERATED).document(gen_id).set(
+    _exam_ref(doc_id, gen_id).set(
         {"status": status, "updated_at": time.time()}, merge=True
     )
+    _changed(doc_id, gen_id)
 
 
-def increment_generated_exam_progress(doc_id: str, gen_id: str) -> Dict[str, Any]:
+def commit_question_done(
+    doc_id: str, gen_id: str, question_index: int, el: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Store a generated question and count it towards progress in one commit"""
     db = get_firestore()
-    ref = (
-        db.collection(DOCS).document(doc_id).collection(SUB_GENERATED).document(gen_id)
+    exam_ref = _exam_ref(doc_id, gen_id)
+    now = time.time()
+    batch = db.batch()
+    batch.set(
+        _generated_question_ref(doc_id, gen_id, str(question_index)),
+        {**el, "status": "done", "updated_at": now},
+        merge=True,
     )
-    ref.set({"completed": Increment(1), "updated_at": time.time()}, merge=True)
-    snap = ref.get().to_dict() or {}
-    # Auto-finish when completed >= total
-    if snap.get("total") and snap.get("completed", 0) >= snap.get("total"):
-        ref.set({"status": "done", "updated_at": time.time()}, merge=True)
+    batch.set(exam_ref, {"completed": Increment(1), "updated_at": now}, merge=True)
+    batch.commit()
+    snap = exam_ref.get(field_paths=["completed", "total", "status"]).to_dict() or {}
+    _finish_if_complete(exam_ref, snap)
+    _changed(doc_id, gen_id)
     return snap
 
 
+def _finish_if_complete(exam_ref, snap: Dict[str, Any]) -> None:
+    total = snap.get("total")
+    # The counter can drift on retries, so it only decides when to look; the
+    # finished question documents decide whether the exam is done
+    if total and snap.get("completed", 0) >= total and snap.get("status") != "done":
+        done = _count_done_questions(exam_ref)
+        if done >= total:
+            patch = {"status": "done", "completed": done, "updated_at": time.time()}
+            exam_ref.set(patch, merge=True)
+            snap.update(patch)
+
+
+def _count_done_questions(exam_ref) -> int:
+    query = exam_ref.collection(SUB_QUESTIONS).where(
+        filter=FieldFilter("status", "==", "done")
+    )
+    return query.count().get()[0][0].value
+
+
 def init_generated_exam_questions(
     doc_id: str, gen_id: str, selected_questions: List[Dict[str, Any]]
 ) -> None:
-    db = get_firestore()
-    base = (
-        db.collection(DOCS).document(doc_id).collection(SUB_GENERATED).document(gen_id)
-    )
-    batch = db.batch()
+    base = _exam_ref(doc_id, gen_id)
     now = time.time()
-
-    for i, original_question in enumerate(selected_questions):
-        # Use increasing index as document ID (0, 1, 2, ...), no index field needed
-        qref = base.collection(SUB_QUESTIONS).document(str(i))
-        batch.set(
-            qref,
+    writes = [
+        (
+            # Use increasing index as document ID (0, 1, 2, ...), no index field needed
+            base.collection(SUB_QUESTIONS).document(str(i)),
             {
-                "original_id": original_question.get(
-                    "id"
-                ),  # Reference to original question
+                # Reference to original question
+                "original_id": original_question.get("id"),
                 "status": "pending",
                 "created_at": now,
             },
-            merge=True,
+            True,
         )
-    batch.commit()
+        for i, original_question in enumerate(selected_questions)
+    ]
+    _commit_batched(writes)
+    _changed(doc_id, gen_id)
 
 
 def set_generated_question_status(
@@ -189,25 +504,17 @@ def set_generated_question_status(
     status: str,
     patch: Optional[Dict[str, Any]] = None,
 ) -> None:
-    db = get_firestore()
-    qref = (
-        db.collection(DOCS)
-        .document(doc_id)
-        .collection(SUB_GENERATED)
-        .document(gen_id)
-        .collection(SUB_QUESTIONS)
-        .document(question_id)
-    )
+    qref = _generated_question_ref(doc_id, gen_id, question_id)
     data: Dict[str, Any] = {"status": status, "updated_at": time.time()}
     if patch:
         data.update(patch)
     qref.set(data, merge=True)
+    _changed(doc_id, gen_id)
 
 
 def list_generated_exams(doc_id: str) -> List[Dict[str, Any]]:
     """List all generated exams for a document"""
-    db = get_firestore()
-    col = db.collection(DOCS).document(doc_id).collection(SUB_GENERATED)
+    col = _doc_ref(doc_id).collection(SUB_GENERATED)
     exams = []
     for doc in col.stream():
         data = doc.to_dict()
@@ -219,74 +526,62 @@ def list_generated_exams(doc_id: str) -> List[Dict[str, Any]]:
 def delete_document(doc_id: str) -> None:
     """Delete a document and all its subcollections"""
     db = get_firestore()
-    doc_ref = db.collection(DOCS).document(doc_id)
-
-    # Delete all generated exams
-    for exam_doc in doc_ref.collection(SUB_GENERATED).stream():
-        # Delete questions in each exam
-        for question_doc in exam_doc.reference.collection(SUB_QUESTIONS).stream():
-            question_doc.reference.delete()
-        exam_doc.reference.delete()
-
-    # Delete all original questions
-    for question_doc in doc_ref.collection(SUB_QUESTIONS).stream():
-        question_doc.reference.delete()
-
-    # Delete the main document
-    doc_ref.delete()
+    doc_ref = _doc_ref(doc_id)
+    # recursive_delete walks generated exams, their questions and the original
+    # questions, queueing every delete on a BulkWriter that batches and
+    # parallelizes the commits
+    db.recursive_delete(doc_ref, bulk_writer=db.bulk_writer())
+    _changed(doc_id, removed=True)
 
 
 def delete_generated_exam(doc_id: str, gen_id: str) -> None:
     """Delete a generated exam and all its questions"""
     db = get_firestore()
-    exam_ref = (
-        db.collection(DOCS).document(doc_id).collection(SUB_GENERATED).document(gen_id)
-    )
-
-    # Delete all questions in the exam
-    for question_doc in exam_ref.collection(SUB_QUESTIONS).stream():
-        question_doc.reference.delete()
-
-    # Delete the exam document
-    exam_ref.delete()
+    exam_ref = _exam_ref(doc_id, gen_id)
+    # Same BulkWriter path as delete_document: the questions and the exam doc
+    # are deleted in pipelined batches instead of one round trip each
+    db.recursive_delete(exam_ref, bulk_writer=db.bulk_writer())
+    _changed(doc_id, gen_id)
 
 
 def update_ocr_page_result(doc_id: str, page_index: int, latex_content: str) -> None:
     """Update OCR result for a specific page and check if all pages are complete"""
     db = get_firestore()
-    doc_ref = db.collection(DOCS).document(doc_id)
+    doc_ref = _doc_ref(doc_id)
 
     try:
-        # Get current document to update ocr_pages properly
-        doc_data = doc_ref.get().to_dict()
-        if not doc_data:
+        # Write only this page's map entry; concurrent pages no longer
+        # overwrite each other's results with a stale copy of ocr_pages
+        page_field = FieldPath("ocr_pages", str(page_index)).to_api_repr()
+        try:
+            doc_ref.update(
+                {
+                    page_field: latex_content,
+                    "ocr_completed": Increment(1),
+                    "updated_at": time.time(),
+                }
+            )
+        except NotFound:
             logger.error("Document %s not found", doc_id)
             return
-
-        # Get current ocr_pages or initialize empty dict
-        ocr_pages = doc_data.get("ocr_pages", {})
-        ocr_pages[str(page_index)] = latex_content  # Use string key for consistency
-
-        # Update the document with new ocr_pages and increment counter
-        doc_ref.set(
-            {
-                "ocr_pages": ocr_pages,
-                "ocr_completed": Increment(1),
-                "updated_at": time.time(),
-            },
-            merge=True,
-        )
+        _changed(doc_id)
 
         logger.info("Updated OCR result for doc %s, page %d", doc_id, page_index)
 
         # Check if all pages are complete
-        completed = doc_data.get("ocr_completed", 0) + 1  # Add 1 for current update
-        total = doc_data.get("ocr_total", 0)
+        counters = (
+            doc_ref.get(field_paths=["ocr_completed", "ocr_total"]).to_dict() or {}
+        )
+        completed = counters.get("ocr_completed", 0)
+        total = counters.get("ocr_total", 0)
         logger.info("OCR progress for doc %s: %d/%d pages", doc_id, completed, total)
 
         if completed >= total and total > 0:
-            # All OCR pages complete, update status and enqueue extraction
-            doc_ref.set({"ocr_status": "done"}, merge=True)
+            # All OCR pages complete. Several pages can finish together and all
+            # see the final count, so only the one that flips the status enqueues
+            if not _mark_ocr_done(db.transaction(), doc_ref):
+                return
+            _changed(doc_id)
             logger.info(
                 "All OCR pages complete for doc %s, enqueuing extraction", doc_id
             )
@@ -306,10 +601,18 @@ def update_ocr_page_result(doc_id: str, page_index: int, latex_content: str) ->
         raise
 
 
+@transactional
+def _mark_ocr_done(transaction, doc_ref) -> bool:
+    snap = doc_ref.get(field_paths=["ocr_status"], transaction=transaction)
+    if (snap.to_dict() or {}).get("ocr_status") == "done":
+        return False
+    transaction.set(doc_ref, {"ocr_status": "done"}, merge=True)
+    return True
+
+
 def get_ocr_pages_results(doc_id: str) -> List[str]:
     """Get all OCR page results in order"""
-    db = get_firestore()
-    doc_data = db.collection(DOCS).document(doc_id).get().to_dict()
+    doc_data = _doc_ref(doc_id).get().to_dict()
 
     if not doc_data:
         logger.error("Document %s not found", doc_id)
@@ -342,8 +645,8 @@ def get_ocr_pages_results(doc_id: str) -> List[str]:
 
 def cleanup_temp_directory(doc_id: str) -> None:
     """Clean up temporary directory after extraction is complete"""
-    db = get_firestore()
-    doc_data = db.collection(DOCS).document(doc_id).get().to_dict()
+    doc_ref = _doc_ref(doc_id)
+    doc_data = doc_ref.get().to_dict()
 
     if not doc_data or "temp_dir" not in doc_data:
         return
@@ -363,4 +666,5 @@ def cleanup_temp_directory(doc_id: str) -> None:
             logger.warning("Failed to delete temp directory %s: %s", temp_dir, e)
 
     # Remove temp_dir from document
-    db.collection(DOCS).document(doc_id).set({"temp_dir": None}, merge=True)
+    doc_ref.set({"temp_dir": None}, merge=True)
+    _changed(doc_id)
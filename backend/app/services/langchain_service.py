@@ -1,13 +1,18 @@
-import json
 import logging
 import os
-from typing import Any, Dict, List
+from functools import lru_cache
+from typing import Any, Dict, List, Type
 
 from langchain_core.runnables import RunnableLambda
 from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.prompts import PromptTemplate
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, ValidationError
 
+from app.core.http_client import get_async_http_client, get_http_client
+from app.core.rate_limit import estimate_tokens, openrouter_limiter
+from app.services.llm_cache import cache_key, cached_call
 from app.schemas.exam import (
     Exam,
     MultipleChoiceQuestionWithAnswer,
@@ -16,25 +21,34 @@ from app.schemas.exam import (
 )
 
 import json_repair
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Approximate size of a generation prompt's static prefix, for rate limiting
+GEN_PROMPT_TOKENS = 1500
 
-def wrapper_json_repair(input):
-    content = input.content.strip()
 
-    if content.startswith("```json"):
-        content = content[7:]
-    if content.endswith("```"):
-        content = content[:-3]
-
-    input.content = json.dumps(json_repair.loads(content))
-    return input
+def wrapper_json_repair(input) -> Any:
+    """Parse the model's (possibly malformed) JSON reply straight into Python data"""
+    content = input.content.strip().removeprefix("```json").removesuffix("```")
+    # Well-formed replies take the fast strict parser; only malformed ones
+    # pay for json_repair
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return json_repair.loads(content)
 
 
 json_repair_lambda = RunnableLambda(wrapper_json_repair)
 
 
+def _example_prompt_input(example_json: Dict[str, Any]) -> Dict[str, str]:
+    # orjson emits UTF-8 like json.dumps(ensure_ascii=False), only faster
+    return {"question": orjson.dumps(example_json).decode("utf-8")}
+
+
+@lru_cache(maxsize=None)
 def _build_llm(model_name: str, temperature: float = 0.2) -> ChatOpenAI:
     api_key = os.getenv("OPENROUTER_API_KEY", "")
     if not api_key:
@@ -44,74 +58,159 @@ def _build_llm(model_name: str, temperature: float = 0.2) -> ChatOpenAI:
         openai_api_key=api_key,
         openai_api_base="https://openrouter.ai/api/v1",
         temperature=temperature,
+        # Share the pooled HTTP/2 clients instead of one connection pool per
+        # LLM; invoke() uses the sync one and ainvoke() the async one
+        http_client=get_http_client(),
+        http_async_client=get_async_http_client(),
     )
 
 
+@lru_cache(maxsize=None)
+def _load_prompt(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=None)
+def _build_chain(
+    prompt_path: str,
+    schema: Type[BaseModel],
+    input_variable: str,
+    model_name: str,
+    temperature: float,
+):
+    # Built once per (prompt, schema, model) and reused for every call. The
+    # parser only supplies format instructions; json_repair already returns
+    # the parsed reply, so it is not parsed a second time
+    parser = JsonOutputParser(pydantic_object=schema)
+    prompt = ChatPromptTemplate.from_messages(
+        _split_prompt(
+            _load_prompt(prompt_path),
+            input_variable,
+            parser.get_format_instructions(),
+        )
+    )
+    return prompt | _build_llm(model_name, temperature) | json_repair_lambda
+
+
+def _split_prompt(template: str, input_variable: str, format_instructions: str):
+    """Split a prompt file into a cacheable static prefix and the dynamic input.
+
+    Everything before the paragraph holding the input placeholder is identical
+    across calls, so it is sent first as a system message marked with
+    cache_control; providers that support prompt caching then only process
+    the short per-call tail.
+    """
+    placeholder = "{" + input_variable + "}"
+    cut = template.rfind("\n\n", 0, template.index(placeholder))
+    static = template[:cut].replace("{format_instructions}", format_instructions)
+    static_block = {
+        "type": "text",
+        "text": static,
+        "cache_control": {"type": "ephemeral"},
+    }
+    return [
+        SystemMessage(content=[static_block]),
+        ("human", template[cut:].strip()),
+    ]
+
+
 def extract_exam_from_latex(latex_pages: List[str]) -> Dict[str, Any]:
+    prompt_path = "./app/prompts/latex_to_json.txt"
     model = os.getenv("OCR_MODEL_NAME")
-    llm = _build_llm(model, temperature=0)
-    parser = JsonOutputParser(pydantic_object=Exam)
-    prompt = PromptTemplate(
-        template=(
-            open("./app/prompts/latex_to_json.txt", "r", encoding="utf-8").read()
-        ),
-        input_variables=["exam_content"],
-        partial_variables={"format_instructions": parser.get_format_instructions()},
-    )
-    chain = prompt | llm | json_repair_lambda | parser
+    chain = _build_chain(prompt_path, Exam, "exam_content", model, 0)
     combined = "\n\\newpage\n".join(latex_pages)
 
-    result = chain.invoke({"exam_content": combined})
+    # Extraction runs at temperature 0, so identical input can reuse the result
+    key = cache_key(
+        kind="extract",
+        model=model,
+        prompt=_load_prompt(prompt_path),
+        content=combined,
+    )
+
+    def extract() -> Dict[str, Any]:
+        # Only a cache miss reaches OpenRouter, so only it is charged. The JSON
+        # reply restates the whole exam, about as many tokens again as the input
+        prompt_text = _load_prompt(prompt_path) + combined
+        openrouter_limiter.acquire(estimate_tokens(prompt_text) * 2)
+        return chain.invoke({"exam_content": combined})
+
+    result = cached_call(key, extract, _is_valid_exam)
     # The parser already returns a dictionary, so we can return it directly
     return result
 
 
-def generate_mcq_from_example(example_json: Dict[str, Any]) -> Dict[str, Any]:
-    model = os.getenv("MCQ_GEN_MODEL_NAME")
-    llm = _build_llm(model, temperature=0.5)
-    parser = JsonOutputParser(pydantic_object=MultipleChoiceQuestionWithAnswer)
-    prompt = PromptTemplate(
-        template=open(
-            "./app/prompts/generate_multiple_choice.txt", "r", encoding="utf-8"
-        ).read(),
-        input_variables=["question"],
-        partial_variables={"format_instructions": parser.get_format_instructions()},
+def _is_valid_exam(value: Any) -> bool:
+    try:
+        Exam.model_validate(value)
+    except ValidationError:
+        return False
+    return True
+
+
+def _mcq_chain():
+    return _build_chain(
+        "./app/prompts/generate_multiple_choice.txt",
+        MultipleChoiceQuestionWithAnswer,
+        "question",
+        os.getenv("MCQ_GEN_MODEL_NAME"),
+        0.5,
     )
-    chain = prompt | llm | json_repair_lambda | parser
-    out = chain.invoke({"question": json.dumps(example_json, ensure_ascii=False)})
+
+
+def _true_false_chain():
+    return _build_chain(
+        "./app/prompts/generate_true_false.txt",
+        TrueFalseQuestionWithAnswer,
+        "question",
+        os.getenv("TFQ_GEN_MODEL_NAME"),
+        0.5,
+    )
+
+
+def _short_answer_chain():
+    return _build_chain(
+        "./app/prompts/generate_short_answer.txt",
+        ShortAnswerQuestionWithAnswer,
+        "question",
+        os.getenv("SAQ_GEN_MODEL_NAME"),
+        0.5,
+    )
+
+
+def generate_mcq_from_example(example_json: Dict[str, Any]) -> Dict[str, Any]:
+    out = _mcq_chain().invoke(_example_prompt_input(example_json))
     # The parser already returns a dictionary, so we can return it directly
     return out
 
 
 def generate_true_false_from_example(example_json: Dict[str, Any]) -> Dict[str, Any]:
-    model = os.getenv("TFQ_GEN_MODEL_NAME")
-    llm = _build_llm(model, temperature=0.5)
-    parser = JsonOutputParser(pydantic_object=TrueFalseQuestionWithAnswer)
-    prompt = PromptTemplate(
-        template=open(
-            "./app/prompts/generate_true_false.txt", "r", encoding="utf-8"
-        ).read(),
-        input_variables=["question"],
-        partial_variables={"format_instructions": parser.get_format_instructions()},
-    )
-    chain = prompt | llm | json_repair_lambda | parser
-    out = chain.invoke({"question": json.dumps(example_json, ensure_ascii=False)})
+    out = _true_false_chain().invoke(_example_prompt_input(example_json))
     # The parser already returns a dictionary, so we can return it directly
     return out
 
 
 def generate_short_answer_from_example(example_json: Dict[str, Any]) -> Dict[str, Any]:
-    model = os.getenv("SAQ_GEN_MODEL_NAME")
-    llm = _build_llm(model, temperature=0.5)
-    parser = JsonOutputParser(pydantic_object=ShortAnswerQuestionWithAnswer)
-    prompt = PromptTemplate(
-        template=open(
-            "./app/prompts/generate_short_answer.txt", "r", encoding="utf-8"
-        ).read(),
-        input_variables=["question"],
-        partial_variables={"format_instructions": parser.get_format_instructions()},
-    )
-    chain = prompt | llm | json_repair_lambda | parser
-    out = chain.invoke({"question": json.dumps(example_json, ensure_ascii=False)})
+    out = _short_answer_chain().invoke(_example_prompt_input(example_json))
     # The parser already returns a dictionary, so we can return it directly
     return out
+
+
+async def generate_question_from_example_async(
+    example_json: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Generate a question of the example's type without blocking the loop"""
+    qtype = example_json.get("type")
+    if qtype == "multiple_choice":
+        chain = _mcq_chain()
+    elif qtype == "true_false":
+        chain = _true_false_chain()
+    else:
+        chain = _short_answer_chain()
+    prompt_input = _example_prompt_input(example_json)
+    # The reply is a worked question of similar size, plus the static prompt
+    await openrouter_limiter.acquire_async(
+        estimate_tokens(prompt_input["question"]) * 3 + GEN_PROMPT_TOKENS
+    )
+    return await chain.ainvoke(prompt_input)
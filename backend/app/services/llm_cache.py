@@ -0,0 +1,59 @@
+import hashlib
+import logging
+import os
+from functools import lru_cache
+from typing import Any, Callable, Optional
+
+import orjson
+from diskcache import Cache
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "/var/cache/dethi_llm")
+LLM_CACHE_SIZE_LIMIT = int(os.getenv("LLM_CACHE_SIZE_LIMIT", str(2 * 1024**3)))
+
+
+@lru_cache(maxsize=1)
+def get_cache() -> Cache:
+    # diskcache is safe to share between the forked RQ work horses
+    return Cache(LLM_CACHE_DIR, size_limit=LLM_CACHE_SIZE_LIMIT)
+
+
+def cache_key(**parts: Any) -> str:
+    """SHA-256 over the canonical JSON of everything that shapes a response"""
+    raw = orjson.dumps(parts, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(raw).hexdigest()
+
+
+def get_cached(key: str) -> Optional[Any]:
+    try:
+        return get_cache().get(key)
+    except Exception as e:  # noqa: BLE001
+        logger.warning("LLM cache read failed: %s", e)
+        return None
+
+
+def set_cached(key: str, value: Any) -> None:
+    if value is None:
+        return
+    try:
+        get_cache().set(key, value)
+    except Exception as e:  # noqa: BLE001
+        logger.warning("LLM cache write failed: %s", e)
+
+
+def cached_call(
+    key: str, compute: Callable[[], Any], is_valid: Callable[[Any], bool]
+) -> Any:
+    """Return the stored response for key, or compute it.
+
+    Only responses that pass is_valid are stored or replayed, so a refusal or
+    an empty reply is retried next time instead of being kept forever.
+    """
+    value = get_cached(key)
+    if value is not None and is_valid(value):
+        return value
+    value = compute()
+    if is_valid(value):
+        set_cached(key, value)
+    return value
@@ -1,33 +1,96 @@
 import base64
-import glob
+import fcntl
+import hashlib
 import logging
 import os
 import subprocess
 import tempfile
-from typing import List, Optional
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import requests
+import httpx
+from tenacity import (
+    RetryCallState,
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from app.core.http_client import get_http_client
+from app.core.rate_limit import openrouter_limiter
+from app.services.llm_cache import cache_key, get_cached, set_cached
 
 logger = logging.getLogger(__name__)
 
+OPENROUTER_CHAT_URL = "https://openrouter.ai/api/v1/chat/completions"
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+# Rough prompt + image + reply token cost of one page, for the rate limiter
+OCR_EXPECTED_TOKENS = int(os.getenv("OCR_EXPECTED_TOKENS", "3000"))
+# Page rendering for OCR; vision models read 200 DPI JPEG as well as 300 DPI
+# PNG at a fraction of the upload size
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+OCR_JPEG_QUALITY = int(os.getenv("OCR_JPEG_QUALITY", "85"))
+# Read size when encoding page images; a multiple of 3 keeps base64 unpadded
+B64_CHUNK_SIZE = 3 * 64 * 1024
+# Warm LibreOffice profiles shared by every conversion on this machine
+SOFFICE_PROFILE_ROOT = os.getenv("SOFFICE_PROFILE_ROOT", "/tmp/soffice-profiles")
+SOFFICE_PROFILE_SLOTS = int(
+    os.getenv("SOFFICE_PROFILE_SLOTS", str(os.cpu_count() or 1))
+)
+OCR_PROMPT = (
+    "Convert a math exam to latex code. If there is a figure, image, graph, chart or table, just ignore it, do not try to recreate it in LaTeX."
+    "Output ONLY raw LaTeX for this page, no preamble or document wrappers."
+)
+
+
+@contextmanager
+def _soffice_profile() -> Iterator[str]:
+    """Lease one of the persistent LibreOffice user profiles.
+
+    A fresh soffice spends most of its startup creating and migrating its
+    user profile. Reusing an already initialized profile skips that, but a
+    profile can only be used by one instance at a time, so each conversion
+    holds an exclusive lock on its slot.
+    """
+    os.makedirs(SOFFICE_PROFILE_ROOT, exist_ok=True)
+    while True:
+        for slot in range(SOFFICE_PROFILE_SLOTS):
+            lock = open(os.path.join(SOFFICE_PROFILE_ROOT, f"{slot}.lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            try:
+                yield os.path.join(SOFFICE_PROFILE_ROOT, str(slot))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+            return
+        time.sleep(0.1)
+
 
 def convert_to_pdf(input_file: str, output_dir: str) -> Optional[str]:
     logger.info("Converting %s to PDF", input_file)
     try:
-        subprocess.run(
-            [
-                "soffice",
-                "--headless",
-                "--convert-to",
-                "pdf",
-                "--outdir",
-                output_dir,
-                input_file,
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
-        )
+        with _soffice_profile() as profile:
+            subprocess.run(
+                [
+                    "soffice",
+                    f"-env:UserInstallation=file://{profile}",
+                    "--headless",
+                    "--convert-to",
+                    "pdf",
+                    "--outdir",
+                    output_dir,
+                    input_file,
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
         pdf_filename = os.path.splitext(os.path.basename(input_file))[0] + ".pdf"
         return os.path.join(output_dir, pdf_filename)
     except FileNotFoundError:
@@ -38,32 +101,186 @@ def convert_to_pdf(input_file: str, output_dir: str) -> Optional[str]:
         return None
 
 
-def pdf_to_images(pdf_path: str, output_prefix: str) -> List[str]:
-    if not pdf_path:
-        return []
-    logger.info("Converting PDF pages to images: %s", pdf_path)
+def _pdftoppm_args(pdf_path: str, output_prefix: str) -> List[str]:
+    return [
+        "pdftoppm",
+        # Number single-page documents too, so output names are predictable
+        "-forcenum",
+        "-jpeg",
+        "-jpegopt",
+        f"quality={OCR_JPEG_QUALITY}",
+        "-r",
+        str(OCR_DPI),
+        pdf_path,
+        output_prefix,
+    ]
+
+
+def page_image_paths(output_prefix: str, total_pages: int) -> List[str]:
+    """Files pdftoppm writes for pages 1..total_pages, in page order.
+
+    pdftoppm zero-pads page numbers to the width of the last page number.
+    """
+    digits = len(str(total_pages))
+    return [
+        f"{output_prefix}-{page:0{digits}d}.jpg" for page in range(1, total_pages + 1)
+    ]
+
+
+def pdf_page_count(pdf_path: str) -> int:
     try:
-        subprocess.run(
-            [
-                "pdftoppm",
-                "-png",
-                "-r",
-                "300",
-                pdf_path,
-                output_prefix,
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
+        result = subprocess.run(
+            ["pdfinfo", pdf_path], check=True, capture_output=True, text=True
         )
-        image_files = sorted(glob.glob(f"{output_prefix}*.png"))
-        return image_files
     except FileNotFoundError:
-        logger.error("'pdftoppm' not found. Is poppler-utils installed?")
-        return []
+        logger.error("'pdfinfo' not found. Is poppler-utils installed?")
+        return 0
     except subprocess.CalledProcessError as e:
-        logger.error("Error during image conversion: %s", e.stderr)
-        return []
+        logger.error("Error reading PDF info: %s", e.stderr)
+        return 0
+    for line in result.stdout.splitlines():
+        if line.startswith("Pages:"):
+            return int(line.split(":", 1)[1])
+    return 0
+
+
+def iter_pdf_images(
+    pdf_path: str, output_prefix: str, total_pages: int
+) -> Iterator[str]:
+    """Yield page images in order as pdftoppm finishes writing each one"""
+    logger.info("Streaming PDF pages to images: %s", pdf_path)
+    # stderr goes to a file: nothing reads a pipe while pages are polled, and
+    # a malformed PDF's warnings would fill it and block pdftoppm
+    with tempfile.TemporaryFile(mode="w+") as errors:
+        try:
+            proc = subprocess.Popen(
+                _pdftoppm_args(pdf_path, output_prefix),
+                stdout=subprocess.DEVNULL,
+                stderr=errors,
+            )
+        except FileNotFoundError:
+            logger.error("'pdftoppm' not found. Is poppler-utils installed?")
+            return
+        paths = page_image_paths(output_prefix, total_pages)
+        emitted = 0
+        while emitted < len(paths):
+            finished = proc.poll() is not None
+            # Pages are written in order; a page is complete once the next one
+            # has been started or pdftoppm has exited
+            while emitted < len(paths) and (
+                (emitted + 1 < len(paths) and os.path.exists(paths[emitted + 1]))
+                or (finished and os.path.exists(paths[emitted]))
+            ):
+                yield paths[emitted]
+                emitted += 1
+            if finished:
+                break
+            time.sleep(0.05)
+        proc.wait()
+        if proc.returncode != 0:
+            errors.seek(0)
+            logger.error("Error during image conversion: %s", errors.read())
+
+
+def _read_image(image_path: str, model_name: str) -> Tuple[str, str]:
+    mime = "image/png" if image_path.lower().endswith(".png") else "image/jpeg"
+    with open(image_path, "rb") as f:
+        chunks = iter(lambda: f.read(B64_CHUNK_SIZE), b"")
+        return _encode_image(chunks, mime, model_name)
+
+
+def _encode_image(
+    chunks: Iterable[bytes], mime: str, model_name: str
+) -> Tuple[str, str]:
+    """Return the page as a base64 data URL together with its cache key.
+
+    The image is hashed and encoded in chunks whose size is a multiple of 3,
+    so base64 chunks concatenate without padding and no second full copy of
+    the raw image is made.
+    """
+    digest = hashlib.sha256()
+    url = bytearray(f"data:{mime};base64,".encode("ascii"))
+    for chunk in chunks:
+        digest.update(chunk)
+        url += base64.b64encode(chunk)
+    # Same page image, model and prompt always ask for the same transcription
+    key = cache_key(
+        kind="ocr", model=model_name, prompt=OCR_PROMPT, image=digest.hexdigest()
+    )
+    return url.decode("ascii"), key
+
+
+def _ocr_payload(image_url: str, model_name: str) -> Dict[str, Any]:
+    return {
+        "model": model_name,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": OCR_PROMPT},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ],
+            }
+        ],
+    }
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.TransportError):
+        return True
+    return (
+        isinstance(exc, httpx.HTTPStatusError)
+        and exc.response.status_code in RETRYABLE_STATUS
+    )
+
+
+_backoff = wait_random_exponential(multiplier=1, max=30)
+
+
+def _retry_wait(retry_state: RetryCallState) -> float:
+    # Prefer the server's Retry-After (seconds) over our own backoff
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = exc.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), 60.0)
+    return _backoff(retry_state)
+
+
+def _log_retry(retry_state: RetryCallState) -> None:
+    logger.warning(
+        "OCR request failed (attempt %d), retrying: %s",
+        retry_state.attempt_number,
+        retry_state.outcome.exception(),
+    )
+
+
+# Transient upstream errors (429, 5xx, dropped connections) are retried
+# instead of turning the page into an OCR error
+ocr_retry = retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=_retry_wait,
+    stop=stop_after_attempt(6),
+    before_sleep=_log_retry,
+    reraise=True,
+)
+
+
+@ocr_retry
+def _post_ocr(payload: Dict[str, Any], api_key: str) -> str:
+    # Each attempt, retries included, counts against the shared budget
+    openrouter_limiter.acquire(OCR_EXPECTED_TOKENS)
+    response = get_http_client().post(
+        OPENROUTER_CHAT_URL,
+        headers={"Authorization": f"Bearer {api_key}"},
+        json=payload,
+    )
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"]
+
+
+def _is_usable_latex(value: Any) -> bool:
+    return isinstance(value, str) and bool(value.strip())
 
 
 def image_to_latex(image_path: str, api_key: str, model_name: str) -> Optional[str]:
@@ -71,63 +288,16 @@ def image_to_latex(image_path: str, api_key: str, model_name: str) -> Optional[s
         logger.error("OPENROUTER_API_KEY not set")
         return None
     logger.info("Converting image to LaTeX: %s", os.path.basename(image_path))
-    with open(image_path, "rb") as f:
-        base64_image = base64.b64encode(f.read()).decode("utf-8")
-    prompt = (
-        "Convert a math exam to latex code. If there is a figure, image, graph, chart or table, just ignore it, do not try to recreate it in LaTeX."
-        "Output ONLY raw LaTeX for this page, no preamble or document wrappers."
-    )
+    image_url, key = _read_image(image_path, model_name)
+    cached = get_cached(key)
+    if _is_usable_latex(cached):
+        return cached
     try:
-        response = requests.post(
-            url="https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": model_name,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{base64_image}"
-                                },
-                            },
-                        ],
-                    }
-                ],
-            },
-            timeout=120,
-        )
-        response.raise_for_status()
-        data = response.json()
-        return data["choices"][0]["message"]["content"]
+        latex = _post_ocr(_ocr_payload(image_url, model_name), api_key)
+        # An empty reply would otherwise become a permanent error page
+        if _is_usable_latex(latex):
+            set_cached(key, latex)
+        return latex
     except Exception as e:  # noqa: BLE001
         logger.exception("OCR API request failed: %s", e)
         return None
-
-
-def ocr_document_to_latex(
-    local_doc_path: str, api_key: str, ocr_model: str
-) -> List[str]:
-    with tempfile.TemporaryDirectory() as tmpdir:
-        if local_doc_path.lower().endswith(".pdf"):
-            pdf_path = local_doc_path
-        else:
-            pdf_path = convert_to_pdf(local_doc_path, tmpdir)
-        if not pdf_path:
-            return []
-        prefix = os.path.join(tmpdir, os.path.splitext(os.path.basename(pdf_path))[0])
-        images = pdf_to_images(pdf_path, prefix)
-        pages: List[str] = []
-        for img in images:
-            latex = image_to_latex(img, api_key, ocr_model)
-            if latex:
-                pages.append(latex)
-            else:
-                pages.append("% ERROR: OCR failed on page")
-        return pages
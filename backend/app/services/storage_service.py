@@ -1,11 +1,26 @@
 import logging
 import os
-from typing import Tuple
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from google.cloud.exceptions import NotFound
 
 from app.core.firebase import get_bucket
 
 logger = logging.getLogger(__name__)
 
+# Resumable upload chunk size, must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Stream Storage objects with 1 MiB ranged reads, yielded as 64 KiB chunks
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".pdf": "application/pdf",
+}
+
 
 def upload_file(local_path: str, dest_path: str, content_type: str = None) -> str:
     bucket = get_bucket()
@@ -13,20 +28,51 @@ def upload_file(local_path: str, dest_path: str, content_type: str = None) -> st
 
     # Auto-detect content type if not provided
     if content_type is None:
-        if dest_path.lower().endswith(".png"):
-            content_type = "image/png"
-        elif dest_path.lower().endswith(".jpg") or dest_path.lower().endswith(".jpeg"):
-            content_type = "image/jpeg"
-        elif dest_path.lower().endswith(".pdf"):
-            content_type = "application/pdf"
-        else:
-            content_type = "application/octet-stream"
+        ext = os.path.splitext(dest_path)[1].lower()
+        content_type = CONTENT_TYPES.get(ext, "application/octet-stream")
 
     blob.upload_from_filename(local_path, content_type=content_type)
     logger.info("Uploaded file to %s", dest_path)
     return dest_path
 
 
+def upload_fileobj(
+    fileobj: BinaryIO, dest_path: str, content_type: str = "application/octet-stream"
+) -> int:
+    """Stream a file-like object to Storage with a chunked resumable upload.
+
+    Returns the number of bytes stored, as reported by Storage.
+    """
+    bucket = get_bucket()
+    blob = bucket.blob(dest_path, chunk_size=UPLOAD_CHUNK_SIZE)
+    blob.upload_from_file(fileobj, content_type=content_type, rewind=True)
+    size = blob.size if blob.size is not None else fileobj.tell()
+    logger.info("Uploaded stream to %s (%d bytes)", dest_path, size)
+    return size
+
+
+def upload_bytes(data: bytes, dest_path: str, content_type: str) -> str:
+    bucket = get_bucket()
+    blob = bucket.blob(dest_path)
+    blob.upload_from_string(data, content_type=content_type)
+    logger.info("Uploaded %d bytes to %s", len(data), dest_path)
+    return dest_path
+
+
+def open_stream(storage_path: str) -> Optional[Tuple[Iterator[bytes], int]]:
+    """Return (chunk iterator, size) for a Storage object, or None if it does not exist"""
+    bucket = get_bucket()
+    blob = bucket.get_blob(storage_path)
+    if blob is None:
+        return None
+
+    def _iter() -> Iterator[bytes]:
+        with blob.open("rb", chunk_size=DOWNLOAD_CHUNK_SIZE) as f:
+            yield from iter(lambda: f.read(STREAM_CHUNK_SIZE), b"")
+
+    return _iter(), blob.size
+
+
 def download_file(storage_path: str, local_path: str) -> str:
     bucket = get_bucket()
     blob = bucket.blob(storage_path)
@@ -40,17 +86,27 @@ def delete_file(storage_path: str) -> None:
     """Delete a file from Firebase Storage"""
     bucket = get_bucket()
     blob = bucket.blob(storage_path)
-    if blob.exists():
+    try:
         blob.delete()
         logger.info("Deleted file %s", storage_path)
-    else:
+    except NotFound:
         logger.warning("File %s does not exist, skipping delete", storage_path)
 
 
+def delete_prefix(prefix: str) -> int:
+    """Delete every Storage object under prefix in batched requests"""
+    bucket = get_bucket()
+    blobs = list(bucket.list_blobs(prefix=prefix))
+    if blobs:
+        # Missing objects are ignored rather than failing the whole batch
+        bucket.delete_blobs(blobs, on_error=lambda blob: None)
+        logger.info("Deleted %d files under %s", len(blobs), prefix)
+    return len(blobs)
+
+
 def get_public_url(storage_path: str) -> str:
     bucket = get_bucket()
     blob = bucket.blob(storage_path)
-    if not blob.exists():
-        raise FileNotFoundError(storage_path)
+    # Signing is local; a missing object surfaces as a 404 when the URL is used
     url = blob.generate_signed_url(expiration=3600)
     return url
@@ -26,18 +26,11 @@ def enqueue_ocr(doc_id: str, storage_path: str) -> str:
     return job.id
 
 
-def enqueue_ocr_pages(doc_id: str, image_paths: List[str]) -> List[str]:
-    """Enqueue parallel OCR jobs for each page using local image files"""
+def enqueue_ocr_page(doc_id: str, image_path: str, page_index: int) -> str:
+    """Enqueue the OCR job for one rendered page"""
     q = get_queue("ocr")
-    jobs = []
-    for page_index, image_path in enumerate(image_paths):
-        job = q.enqueue(
-            "app.workers.tasks.ocr_single_page", doc_id, image_path, page_index
-        )
-        jobs.append(job.id)
-
-    logger.info("Enqueued %d OCR page jobs for doc %s", len(jobs), doc_id)
-    return jobs
+    job = q.enqueue("app.workers.tasks.ocr_single_page", doc_id, image_path, page_index)
+    return job.id
 
 
 def enqueue_extract(doc_id: str) -> str:
@@ -55,13 +48,21 @@ def enqueue_generate_questions(
     target_count: int,
 ) -> List[str]:
     q = get_queue("generate")
-    jobs = []
-    for idx, qdata in enumerate(selected_questions[:target_count]):
-        job = q.enqueue(
-            "app.workers.tasks.generate_one_question", doc_id, gen_id, qdata, idx
-        )
-        jobs.append(job.id)
+    questions = selected_questions[:target_count]
+    # One job fans out over every question in-process, so worker startup and
+    # chain construction are paid once per exam instead of once per question
+    job = q.enqueue(
+        "app.workers.tasks.generate_all_questions",
+        doc_id,
+        gen_id,
+        questions,
+        job_timeout=600 + 60 * len(questions),
+    )
     logger.info(
-        "Enqueued %d question jobs for doc %s gen %s", len(jobs), doc_id, gen_id
+        "Enqueued generation job %s for %d questions of doc %s gen %s",
+        job.id,
+        len(questions),
+        doc_id,
+        gen_id,
     )
-    return jobs
+    return [job.id]
@@ -1,17 +1,14 @@
-import json
+import asyncio
 import logging
 import os
-import tempfile
 from typing import Any, Dict, List
 
 from app.core.firebase import init_firebase
+from app.core.http_client import get_worker_loop
 from app.services.firestore_service import (
-    append_generated_question,
-    create_generated_exam,
-    increment_generated_exam_progress,
+    commit_question_done,
     set_generated_question_status,
     save_original_exam,
-    set_generated_exam_status,
     update_document,
 )
 from app.services.langchain_service import (
@@ -19,12 +16,15 @@ from app.services.langchain_service import (
     generate_mcq_from_example,
     generate_short_answer_from_example,
     generate_true_false_from_example,
+    generate_question_from_example_async,
 )
-from app.services.ocr_service import ocr_document_to_latex
 from app.services.storage_service import download_file
 
 logger = logging.getLogger(__name__)
 
+# Questions of one generated exam that are in flight with the LLM at once
+GEN_MAX_CONCURRENCY = int(os.getenv("GEN_MAX_CONCURRENCY", "16"))
+
 
 def _ensure_init():
     # RQ worker process needs Firebase initialized
@@ -49,7 +49,11 @@ def ocr_and_extract(doc_id: str, storage_path: str) -> None:
             download_file(storage_path, local_path)
 
             # Get the number of pages first
-            from app.services.ocr_service import convert_to_pdf, pdf_to_images
+            from app.services.ocr_service import (
+                convert_to_pdf,
+                iter_pdf_images,
+                pdf_page_count,
+            )
 
             if local_path.lower().endswith(".pdf"):
                 pdf_path = local_path
@@ -59,15 +63,13 @@ def ocr_and_extract(doc_id: str, storage_path: str) -> None:
             if not pdf_path:
                 raise Exception("Failed to convert document to PDF")
 
-            # Convert to images ONCE and store in shared temp directory
-            prefix = os.path.join(shared_temp_dir, "page")
-            images = pdf_to_images(pdf_path, prefix)
-            total_pages = len(images)
+            total_pages = pdf_page_count(pdf_path)
 
             if total_pages == 0:
                 raise Exception("No pages found in document")
 
-            # Update document with OCR progress tracking and temp directory path
+            # Update document with OCR progress tracking and temp directory path.
+            # The total must be stored before any page job can finish
             update_document(
                 doc_id,
                 {
@@ -78,10 +80,20 @@ def ocr_and_extract(doc_id: str, storage_path: str) -> None:
                 },
             )
 
-            # Enqueue parallel OCR jobs for each page with local image paths
-            from app.workers.queues import enqueue_ocr_pages
+            # Render pages ONCE into the shared temp directory and enqueue each
+            # page's OCR job as soon as its image is written
+            from app.workers.queues import enqueue_ocr_page
 
-            enqueue_ocr_pages(doc_id, images)
+            prefix = os.path.join(shared_temp_dir, "page")
+            rendered = 0
+            for image in iter_pdf_images(pdf_path, prefix, total_pages):
+                enqueue_ocr_page(doc_id, image, rendered)
+                rendered += 1
+
+            if rendered != total_pages:
+                raise Exception(
+                    f"Rendered {rendered} of {total_pages} pages from document"
+                )
 
         except Exception as e:
             # Clean up temp directory on error
@@ -197,10 +209,64 @@ def generate_one_question(
             new_q = generate_short_answer_from_example(q)
         # Add original_id to the generated question
         new_q["original_id"] = q.get("id")
-        append_generated_question(doc_id, gen_id, question_index, new_q)
-        increment_generated_exam_progress(doc_id, gen_id)
+        commit_question_done(doc_id, gen_id, question_index, new_q)
     except Exception as e:  # noqa: BLE001
         logger.exception("generate_one_question failed: %s", e)
         set_generated_question_status(
             doc_id, gen_id, str(question_index), "error", {"error": str(e)}
         )
+
+
+def generate_all_questions(
+    doc_id: str, gen_id: str, questions: List[Dict[str, Any]]
+) -> None:
+    """Generate every question of an exam from one job, concurrently"""
+    _ensure_init()
+    get_worker_loop().run_until_complete(
+        _generate_all_questions(doc_id, gen_id, questions)
+    )
+
+
+async def _generate_all_questions(
+    doc_id: str, gen_id: str, questions: List[Dict[str, Any]]
+) -> None:
+    semaphore = asyncio.Semaphore(GEN_MAX_CONCURRENCY)
+
+    async def generate(question_index: int, q: Dict[str, Any]) -> None:
+        async with semaphore:
+            await _generate_question_async(doc_id, gen_id, q, question_index)
+
+    await asyncio.gather(*(generate(i, q) for i, q in enumerate(questions)))
+
+
+async def _generate_question_async(
+    doc_id: str, gen_id: str, q: Dict[str, Any], question_index: int
+) -> None:
+    # Firestore calls stay synchronous and run on threads so the LLM
+    # requests of other questions keep progressing meanwhile
+    try:
+        await asyncio.to_thread(
+            set_generated_question_status,
+            doc_id,
+            gen_id,
+            str(question_index),
+            "processing",
+        )
+        new_q = await generate_question_from_example_async(q)
+        # Add original_id to the generated question
+        new_q["original_id"] = q.get("id")
+        await asyncio.to_thread(
+            commit_question_done, doc_id, gen_id, question_index, new_q
+        )
+    except Exception as e:  # noqa: BLE001
+        logger.exception(
+            "generate_all_questions failed on question %d: %s", question_index, e
+        )
+        await asyncio.to_thread(
+            set_generated_question_status,
+            doc_id,
+            gen_id,
+            str(question_index),
+            "error",
+            {"error": str(e)},
+        )
@@ -0,0 +1,113 @@
+from typing import Any, Dict, List, Tuple
+
+import orjson
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from app.services import firestore_service
+
+
+class FakeRef:
+    def __init__(self, collection: "FakeCollection", doc_id: str) -> None:
+        self.collection_ref = collection
+        self.id = doc_id
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id: str, data: Dict[str, Any]) -> None:
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self._data)
+
+
+class FakeCollection:
+    """Just enough of a Firestore collection: documents stream in id order"""
+
+    def __init__(self) -> None:
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        self.ordered_by: List[str] = []
+
+    def document(self, doc_id: str) -> FakeRef:
+        return FakeRef(self, doc_id)
+
+    def order_by(self, field_path: str) -> "FakeCollection":
+        self.ordered_by.append(field_path)
+        return self
+
+    def stream(self) -> List[FakeSnapshot]:
+        # Firestore compares document ids as strings
+        return [FakeSnapshot(i, d) for i, d in sorted(self.docs.items())]
+
+
+class FakeDocRef:
+    def __init__(self) -> None:
+        self.questions = FakeCollection()
+        self.data: Dict[str, Any] = {}
+
+    def collection(self, name: str) -> FakeCollection:
+        assert name == firestore_service.SUB_QUESTIONS
+        return self.questions
+
+
+def _apply(doc_ref: FakeDocRef):
+    def commit(writes: List[Tuple[Any, Dict[str, Any], bool]]) -> None:
+        for ref, data, _merge in writes:
+            if ref is doc_ref:
+                doc_ref.data.update(data)
+            else:
+                ref.collection_ref.docs[ref.id] = data
+
+    return commit
+
+
+def test_original_questions_come_back_in_question_order(monkeypatch):
+    doc_ref = FakeDocRef()
+    monkeypatch.setattr(firestore_service, "_doc_ref", lambda doc_id: doc_ref)
+    monkeypatch.setattr(firestore_service, "_commit_batched", _apply(doc_ref))
+    monkeypatch.setattr(firestore_service, "_publish_change", lambda change: None)
+
+    # Past ten questions unpadded ids would stream as 0, 1, 10, 11, 2, ...
+    elements: List[Dict[str, Any]] = [{"type": "text", "content": "Phần I"}]
+    for question_index in range(25):
+        elements.append(
+            {
+                "type": "short_answer",
+                "content": f"q{question_index}",
+                "data": {},
+            }
+        )
+    firestore_service.save_original_exam("doc", {"metadata": {}, "elements": elements})
+
+    streamed = [snap.to_dict()["content"] for snap in doc_ref.questions.stream()]
+    assert streamed == [f"q{i}" for i in range(25)]
+
+    questions = firestore_service.list_original_questions("doc")
+    assert doc_ref.questions.ordered_by == [FieldPath.document_id()]
+    assert [q["content"] for q in questions] == [f"q{i}" for i in range(25)]
+    assert [int(q["id"]) for q in questions] == list(range(25))
+    assert doc_ref.data["original_exam"]["type"] == "original"
+
+
+def test_published_removal_evicts_document_exams_and_owner(monkeypatch):
+    published: List[Dict[str, Any]] = []
+    monkeypatch.setattr(firestore_service, "_publish_change", published.append)
+    firestore_service._doc_cache["doc"] = {"id": "doc"}
+    firestore_service._owner_cache["doc"] = "uid"
+    firestore_service._exam_cache[("doc", "gen")] = {"elements": []}
+    firestore_service._exam_cache[("other", "gen")] = {"elements": []}
+
+    # What a subscribed process receives after another one deletes "doc"
+    firestore_service._on_change(
+        {"data": orjson.dumps({"doc": "doc", "gen": None, "removed": True})}
+    )
+
+    assert "doc" not in firestore_service._doc_cache
+    assert "doc" not in firestore_service._owner_cache
+    assert ("doc", "gen") not in firestore_service._exam_cache
+    assert ("other", "gen") in firestore_service._exam_cache
+
+    firestore_service._changed("other", "gen")
+    assert ("other", "gen") not in firestore_service._exam_cache
+    assert published == [{"doc": "other", "gen": "gen", "removed": False}]
+    firestore_service.stop_cache_invalidation()